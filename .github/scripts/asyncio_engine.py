@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Asyncio engine for the ESP32 Stats MQTT Collector
+Drives one or more paho clients from an asyncio event loop instead of loop_start() threads
+"""
+
+import time
+import signal
+import threading
+import asyncio
+import logging
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioMqttConnection:
+    """One paho client whose socket is serviced by the event loop"""
+
+    def __init__(self, engine, index):
+        self.engine = engine
+        self.collector = engine.collector
+        self.index = index
+        self.loop = engine.loop
+        self.sock = None
+        self.fd = None
+        self.misc_task = None
+        self.pending_subscriptions = set()
+
+        # Awaitable lifecycle instead of polling self.connected
+        self.connected = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.disconnected = asyncio.Event()
+
+        protocol = mqtt.MQTTv5 if engine.share_group else mqtt.MQTTv311
+        # A single connection reuses the collector's client id so a persistent session carries over
+        # from the thread engine; several connections each need their own (stable) id
+        client_id = engine.client_id if engine.connection_count == 1 else f"{engine.client_id}-{index}"
+        persistent = engine.persistent_session
+        self.connect_options = {}
+        if protocol == mqtt.MQTTv5:
+            self.client = mqtt.Client(client_id=client_id, protocol=protocol)
+            self.connect_options['clean_start'] = not persistent
+            if persistent:
+                properties = Properties(PacketTypes.CONNECT)
+                properties.SessionExpiryInterval = engine.session_expiry
+                self.connect_options['properties'] = properties
+        else:
+            self.client = mqtt.Client(client_id=client_id, clean_session=not persistent)
+
+        if self.collector.username:
+            self.client.username_pw_set(self.collector.username, self.collector.password)
+        if self.collector.use_tls:
+            self.client.tls_set()
+
+        self.client.on_connect = self.on_connect
+        self.client.on_subscribe = self.on_subscribe
+        self.client.on_message = self.on_message
+        self.client.on_disconnect = self.on_disconnect
+
+        self.client.on_socket_open = lambda client, userdata, sock: self.dispatch(self.socket_open, sock)
+        self.client.on_socket_close = lambda client, userdata, sock: self.dispatch(self.socket_close, sock)
+        self.client.on_socket_register_write = lambda client, userdata, sock: self.dispatch(self.register_write, sock)
+        self.client.on_socket_unregister_write = lambda client, userdata, sock: self.dispatch(self.unregister_write, sock)
+
+    def dispatch(self, callback, sock):
+        """Run a socket callback on the loop; paho calls them from the connect() executor thread too"""
+        if threading.get_ident() == self.engine.loop_thread:
+            callback(sock)
+        else:
+            # By the time this runs the socket may be closed, so callbacks work on the saved fd
+            self.loop.call_soon_threadsafe(callback, sock)
+
+    def socket_open(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.loop.add_reader(self.fd, self.client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def socket_close(self, sock):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+        self.sock = None
+        self.fd = None
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+            self.misc_task = None
+
+    def register_write(self, sock):
+        if self.fd is not None:
+            self.loop.add_writer(self.fd, self.client.loop_write)
+
+    def unregister_write(self, sock):
+        if self.fd is not None:
+            self.loop.remove_writer(self.fd)
+
+    async def misc_loop(self):
+        """Keepalive pings and retries; paho wants this called about once a second"""
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc != 0:
+            logger.error(f"❌ Connection {self.index} refused, return code {rc}")
+            return
+
+        logger.info(f"✅ Connection {self.index} connected")
+        self.collector.connects.inc()
+        self.collector.connection_timer.mark(True)
+        self.collector.connected = True
+        self.disconnected.clear()
+        self.connected.set()
+
+        self.pending_subscriptions = set()
+        for topic in self.collector.subscriptions:
+            if self.engine.share_group:
+                topic = f"$share/{self.engine.share_group}/{topic}"
+            result, mid = client.subscribe(topic, qos=0)
+            self.pending_subscriptions.add(mid)
+            logger.info(f"📡 Connection {self.index} subscribed to {topic}")
+
+    def on_subscribe(self, client, userdata, mid, granted, properties=None):
+        self.pending_subscriptions.discard(mid)
+        if not self.pending_subscriptions:
+            self.ready.set()
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        logger.info(f"📴 Connection {self.index} disconnected (rc {rc})")
+        self.connected.clear()
+        self.ready.clear()
+        self.disconnected.set()
+        self.collector.connected = any(conn.connected.is_set() for conn in self.engine.connections)
+        self.collector.disconnects.inc()
+        if not self.collector.connected:
+            self.collector.connection_timer.mark(False)
+
+    def on_message(self, client, userdata, msg):
+        # Hand off to the ingest queue: the worker takes collector.lock, which saves and flushes
+        # also hold from to_thread, so processing here would stall the event loop behind them
+        self.collector.on_message(client, userdata, msg)
+
+    async def connect(self):
+        """Open the connection; the blocking TCP/TLS handshake runs in an executor"""
+        await self.loop.run_in_executor(
+            None, lambda: self.client.connect(self.collector.broker_host, self.collector.broker_port, 60,
+                                              **self.connect_options))
+
+    async def supervise(self):
+        """Reconnect with backoff whenever the connection drops, until shutdown"""
+        delay = 1
+        while not self.engine.shutdown.is_set():
+            await self.disconnected.wait()
+            if self.engine.shutdown.is_set():
+                break
+
+            await asyncio.sleep(delay)
+            try:
+                await self.loop.run_in_executor(None, self.client.reconnect)
+                delay = 1
+            except Exception as e:
+                logger.error(f"❌ Connection {self.index} reconnect failed: {e}")
+                delay = min(delay * 2, 60)
+
+    async def close(self):
+        if self.sock is not None:
+            self.client.disconnect()
+            # Let the loop flush the DISCONNECT packet and see the socket close
+            for _ in range(50):
+                if self.sock is None:
+                    break
+                await asyncio.sleep(0.01)
+
+
+class AsyncioCollectorEngine:
+    """Run an ESP32StatsCollector's handlers on N asyncio-driven broker connections"""
+
+    def __init__(self, collector, connections=1, share_group=None, client_id='server-collector',
+                 persistent_session=False, session_expiry=7 * 86400):
+        if connections > 1 and not share_group:
+            raise ValueError("Multiple connections need a shared subscription group, "
+                             "otherwise every message is delivered to each connection")
+        self.collector = collector
+        self.connection_count = connections
+        self.share_group = share_group
+        self.client_id = client_id
+        self.persistent_session = persistent_session
+        self.session_expiry = session_expiry  # Seconds the broker keeps an MQTT 5 session after a disconnect
+        self.loop = None
+        self.loop_thread = None
+        self.connections = []
+        self.shutdown = None
+
+    def request_shutdown(self):
+        logger.info("🛑 Shutdown requested")
+        self.shutdown.set()
+
+    async def run(self, duration=None, flush_interval=60, snapshot_interval=300, connect_timeout=10):
+        """Collect until duration elapses (or until SIGTERM when duration is None)"""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.shutdown = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(sig, self.request_shutdown)
+
+        collector = self.collector
+        self.connections = [AsyncioMqttConnection(self, i) for i in range(self.connection_count)]
+        start = time.perf_counter()
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*(conn.connect() for conn in self.connections)), connect_timeout)
+            await asyncio.wait_for(asyncio.gather(*(conn.ready.wait() for conn in self.connections)), connect_timeout)
+        except Exception as e:
+            logger.error(f"❌ Failed to connect to MQTT broker: {e!r}")
+            await self.close()
+            return False
+
+        logger.info(f"🚀 {len(self.connections)} connection(s) ready in {(time.perf_counter() - start) * 1000:.0f} ms")
+        collector.start_workers()
+        supervisors = [self.loop.create_task(conn.supervise()) for conn in self.connections]
+
+        deadline = None if duration is None else self.loop.time() + duration
+        last_flush = self.loop.time()
+        while not self.shutdown.is_set():
+            interval = min(flush_interval, collector.presence_interval)
+            timeout = interval if deadline is None else min(interval, deadline - self.loop.time())
+            if timeout <= 0:
+                break
+            try:
+                await asyncio.wait_for(self.shutdown.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            # Takes collector.lock, which the ingest worker holds for whole batches
+            await asyncio.to_thread(collector.expire_stale_devices)
+            if self.loop.time() - last_flush < flush_interval and not self.shutdown.is_set():
+                continue
+            last_flush = self.loop.time()
+            logger.info(f"⏱️ {collector.messages_received} messages received, connected={collector.connected}")
+            await asyncio.to_thread(collector.flush_journal)
+            if collector.snapshot_due(snapshot_interval):
+                await asyncio.to_thread(collector.save_data)
+            collector.export_metrics()
+
+        self.shutdown.set()
+        for task in supervisors:
+            task.cancel()
+        await self.close()
+        await asyncio.to_thread(collector.stop_workers)
+        await asyncio.to_thread(collector.expire_stale_devices, final=True)
+
+        logger.info(f"✅ Collection completed: {collector.messages_received} messages received")
+        collector.close_journal()
+        return collector.save_data()
+
+    async def close(self):
+        await asyncio.gather(*(conn.close() for conn in self.connections), return_exceptions=True)
+        for conn in self.connections:
+            if conn.sock is not None:
+                conn.socket_close(conn.sock)
@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the ESP32 Stats MQTT Collector
+micro: per-message cost of individual hot paths, offline
+load:  simulated fleet traffic through the full ingest path, with regression checks for CI
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import statistics
+import tempfile
+import gc
+import tracemalloc
+
+import paho.mqtt.client as mqtt
+from mqtt_collector import ESP32StatsCollector, Device, logger
+from stats_batch import encode_batch, OP_FLASH, OP_ERASE, STATUS_SUCCESS
+
+
+def make_collector(workdir, **options):
+    """Create a collector that starts from an empty stats file in workdir"""
+    os.chdir(workdir)
+    return ESP32StatsCollector(**options)
+
+
+def populate_devices(collector, device_count):
+    """Fill device_stats with device_count synthetic devices"""
+    collector.device_stats = {
+        f'Device {i}': Device(1735689600000, f'dev-{i:06d}')  # 2025-01-01T00:00:00Z
+        for i in range(device_count)
+    }
+    collector.rebuild_device_index()
+
+
+def legacy_scan(device_stats, device_id):
+    """The linear lookup the handlers used before the deviceId index"""
+    for name, device_data in device_stats.items():
+        if device_data.last_device_id == device_id:
+            return name
+    return None
+
+
+def bench_device_lookup(workdir, sizes, messages):
+    """Per-message cost of serial status handling as the fleet grows"""
+    print(f"{'devices':>10} {'handler ns/msg':>16} {'legacy scan ns/lookup':>22}")
+    rng = random.Random(42)
+
+    for size in sizes:
+        collector = make_collector(workdir)
+        populate_devices(collector, size)
+
+        ids = [f'dev-{rng.randrange(size):06d}' for _ in range(messages)]
+        topics = [f'pierre/serial/{device_id}/s1/status' for device_id in ids]
+        payloads = ['connected' if i % 2 else 'disconnected' for i in range(messages)]
+
+        routes = [collector.router.route(topic) for topic in topics]
+        start = time.perf_counter()
+        for route, payload in zip(routes, payloads):
+            collector.handle_serial_status_message(route, payload)
+        handler_ns = (time.perf_counter() - start) / messages * 1e9
+
+        # The linear scan gets slow quickly; sample fewer lookups
+        sample = ids[:max(1, min(messages, 200_000 // size))]
+        start = time.perf_counter()
+        for device_id in sample:
+            legacy_scan(collector.device_stats, device_id)
+        legacy_ns = (time.perf_counter() - start) / len(sample) * 1e9
+
+        print(f"{size:>10} {handler_ns:>16.0f} {legacy_ns:>22.0f}")
+
+
+def bench_registry_memory(workdir, sizes):
+    """Bytes retained per device after loading a stats file of each size"""
+    print(f"{'devices':>10} {'bytes/device':>14} {'load ms':>9}")
+    for size in sizes:
+        devices = {
+            f'Device model {i}': {
+                'flashCount': i % 7,
+                'eraseCount': i % 3,
+                'lastSeen': '2025-10-29T09:45:47.555Z',
+                'online': i % 2 == 0,
+                'lastDeviceId': f'{i:08x}-c17',
+                'appVersion': ('1.2.3', '1.2.4', 'unknown')[i % 3]
+            }
+            for i in range(size)
+        }
+        with open(os.path.join(workdir, 'stats-data.json'), 'w', encoding='utf-8') as f:
+            json.dump({'devices': devices, 'events': []}, f)
+        del devices
+
+        collector = make_collector(workdir)
+        collector.device_stats = {}
+        collector.device_index = {}
+        collector.saved_devices = {}
+        gc.collect()
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        collector.load_existing_data()
+        load_ms = (time.perf_counter() - start) * 1000
+        collector.saved_devices = {}  # Snapshot bookkeeping, not the registry itself
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        os.remove(os.path.join(workdir, 'stats-data.json'))
+        print(f"{size:>10} {retained / size:>14.0f} {load_ms:>9.1f}")
+
+
+def bench_stats_decode(workdir, operations, batch_sizes=(10, 100, 1000)):
+    """Cost per flash/erase operation: one JSON message each vs batched payloads"""
+    print(f"{'encoding':>16} {'ops/message':>12} {'messages':>9} {'us/op':>8} {'bytes/op':>9}")
+    device_count = 50
+    names = [f'Station {i}' for i in range(device_count)]
+
+    def run(label, ops_per_message, traffic):
+        collector = make_collector(workdir)
+        start = time.perf_counter()
+        for topic, payload in traffic:
+            collector.process_message(topic, payload, 1700000000.0)
+        elapsed = time.perf_counter() - start
+        payload_bytes = sum(len(payload) for _, payload in traffic)
+        total = sum(device.flash_count + device.erase_count for device in collector.device_stats.values())
+        assert total == operations, (label, total)
+        print(f"{label:>16} {ops_per_message:>12} {len(traffic):>9} {elapsed / operations * 1e6:>8.2f} "
+              f"{payload_bytes / operations:>9.1f}")
+
+    traffic = []
+    for i in range(operations):
+        operation = 'flash' if i % 3 else 'erase'
+        payload = json.dumps({'event': f'{operation}_success', 'device_name': names[i % device_count],
+                              'app_version': '1.2.3', 'timestamp': 1700000000000 + i})
+        traffic.append((f'pierre/stats/dev-{i % device_count:06d}/{operation}', payload.encode()))
+    run('json', 1, traffic)
+
+    for batch_size in batch_sizes:
+        traffic = []
+        for first in range(0, operations, batch_size):
+            count = min(batch_size, operations - first)
+            device = (first // batch_size) % device_count
+            # One record per operation (repeat=1) so the decoder does the full per-operation work.
+            # A station sends the same batch again and again; each one must still count
+            records = [(OP_FLASH if i % 3 else OP_ERASE, STATUS_SUCCESS, 1, i % 60)
+                       for i in range(count)]
+            traffic.append((f'pierre/stats/dev-{device:06d}/batch', encode_batch(names[device], records, '1.2.3')))
+        run('binary batch', batch_size, traffic)
+
+
+def make_topic_mix(count, device_count=1000, sessions=50):
+    """Topics in roughly the proportions the Android app publishes them"""
+    rng = random.Random(7)
+    leaves = ['info', 'count', 'status', 'config', 'info', 'count']
+    topics = []
+    for _ in range(count):
+        device_id = f'dev-{rng.randrange(device_count):06d}'
+        roll = rng.random()
+        if roll < 0.9:
+            topics.append(f'pierre/serial/{device_id}/s{rng.randrange(sessions)}/{rng.choice(leaves)}')
+        elif roll < 0.95:
+            topics.append(f'pierre/stats/{device_id}/{rng.choice(["flash", "erase"])}')
+        else:
+            topics.append(f'pierre/status/{device_id}/{rng.choice(["online", "offline"])}')
+    return topics
+
+
+def legacy_dispatch(topic, payload, handler):
+    """The substring if/elif chain on_message used before the topic router"""
+    if '/count' in topic and payload != '0':
+        pass
+    if '/config' in topic and 'BUFFER' not in payload:
+        pass
+    if '/status' in topic and payload not in ['connected', 'disconnected']:
+        pass
+
+    if topic.startswith('pierre/stats/'):
+        handler(topic, payload)
+    elif '/count' in topic:
+        handler(topic, payload)
+    elif '/status' in topic and 'pierre/serial/' in topic:
+        handler(topic, payload)
+    elif topic.startswith('pierre/status/'):
+        handler(topic, payload)
+    elif '/info' in topic:
+        # info and session tracking
+        handler(topic, payload)
+        handler(topic, payload)
+
+
+def bench_topic_routing(workdir, messages, sessions):
+    """Messages/second of topic classification: substring chain vs table-driven router"""
+    collector = make_collector(workdir)
+    router = collector.router
+    topics = make_topic_mix(messages, sessions=sessions)
+    payload = 'connected'
+
+    # Both variants end in handlers that record the ids they need;
+    # the legacy handlers split the topic themselves like they used to
+    def legacy_handler(topic, payload):
+        parts = topic.split('/')
+        if len(parts) < 4:
+            return
+        calls.append((parts[2], parts[3]))
+
+    def routed_handler(route, payload):
+        calls.append((route.device_id, route.session_id))
+
+    table = {kind: tuple(routed_handler for _ in handlers) for kind, handlers in collector.handlers.items()}
+
+    calls = []
+    start = time.perf_counter()
+    for topic in topics:
+        legacy_dispatch(topic, payload, legacy_handler)
+    legacy_rate = messages / (time.perf_counter() - start)
+
+    calls = []
+    start = time.perf_counter()
+    for topic in topics:
+        route = router.route(topic)
+        for handler in table[route.kind]:
+            handler(route, payload)
+    router_rate = messages / (time.perf_counter() - start)
+
+    print(f"{sessions:>18} {legacy_rate:>20.0f} {router_rate:>14.0f} {router_rate / legacy_rate:>7.2f}x")
+
+
+def session_traffic(device_id, session_id, device_name, seq):
+    """One flashing session in the shapes the Android app publishes"""
+    serial = f'pierre/serial/{device_id}/{session_id}'
+    stats = json.dumps({
+        'event': 'flash_success',
+        'device_name': device_name,
+        'firmware_type': 'production',
+        'timestamp': 1700000000000 + seq,
+        'session_id': session_id
+    }).encode()
+    return [
+        (f'{serial}/info', f'{device_name}|{seq % 100}'.encode()),
+        (f'{serial}/config', b'BUFFER_SIZE=4096'),
+        (f'{serial}/status', b'connected'),
+        (f'{serial}/count', b'0'),
+        (f'pierre/stats/{device_id}/flash', stats),
+        (f'{serial}/count', b'1'),
+        (f'{serial}/status', b'disconnected'),
+    ]
+
+
+def build_traffic(device_count, sessions_per_device):
+    """Interleaved traffic for device_count devices x sessions_per_device sessions"""
+    traffic = []
+    seq = 0
+    for session in range(sessions_per_device):
+        for device in range(device_count):
+            seq += 1
+            traffic.extend(session_traffic(f'dev-{device:06d}', f's{session:04d}', f'Tablet {device}', seq))
+    return traffic
+
+
+class FakeMessage:
+    """Stand-in for paho's MQTTMessage when no broker is used"""
+    __slots__ = ('topic', 'payload', 'retain')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.retain = False
+
+
+def current_rss_mb():
+    """Resident set size of this process in MiB"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def ingest_in_process(collector, traffic):
+    """Push traffic through on_message -> queue -> worker; returns seconds until drained"""
+    on_message = collector.on_message
+    messages = [FakeMessage(topic, payload) for topic, payload in traffic]
+
+    collector.start_workers()
+    start = time.perf_counter()
+    for msg in messages:
+        on_message(None, None, msg)
+    collector.stop_workers()
+    return time.perf_counter() - start
+
+
+def ingest_via_broker(collector, traffic, host, port, timeout=60):
+    """Publish traffic through a real broker and wait until the collector stops receiving"""
+    collector.broker_host, collector.broker_port = host, port
+    collector.start_workers()
+    collector.client.connect(host, port, 60)
+    collector.client.loop_start()
+    if not collector.connected_event.wait(10):
+        raise RuntimeError(f"Could not connect to broker {host}:{port}")
+    time.sleep(0.5)  # Let the SUBACKs land before publishing
+
+    publisher = mqtt.Client(client_id=f'bench-publisher-{os.getpid()}')
+    publisher.max_queued_messages_set(0)
+    publisher.connect(host, port, 60)
+    publisher.loop_start()
+
+    start = time.perf_counter()
+    for topic, payload in traffic:
+        publisher.publish(topic, payload, qos=0)
+
+    # Done when nothing new arrived for a second
+    last_count, last_change = -1, time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        time.sleep(0.1)
+        if collector.messages_received != last_count:
+            last_count, last_change = collector.messages_received, time.perf_counter()
+        elif time.perf_counter() - last_change >= 1.0:
+            break
+    elapsed = last_change - start
+
+    publisher.loop_stop()
+    publisher.disconnect()
+    collector.client.loop_stop()
+    collector.client.disconnect()
+    collector.stop_workers()
+    return elapsed
+
+
+def handler_latencies(collector, traffic):
+    """Per-message process_message time in microseconds, sorted"""
+    samples = []
+    perf_counter_ns = time.perf_counter_ns
+    with collector.lock:
+        for topic, payload in traffic:
+            ts = time.time()
+            start = perf_counter_ns()
+            collector.process_message(topic, payload, ts)
+            samples.append((perf_counter_ns() - start) / 1000)
+    samples.sort()
+    return samples
+
+
+def bench_load(workdir, device_count, sessions, broker=None, run=0):
+    """Full-path numbers for one fleet size"""
+    rundir = os.path.join(workdir, f'load-{device_count}-{run}')
+    os.makedirs(rundir, exist_ok=True)
+    traffic = build_traffic(device_count, sessions)
+    rss_before = current_rss_mb()
+
+    collector = make_collector(rundir, overflow_policy='block')
+    if broker:
+        host, port = broker
+        elapsed = ingest_via_broker(collector, traffic, host, port)
+    else:
+        elapsed = ingest_in_process(collector, traffic)
+    received = collector.messages_received
+
+    collector.data_changed = True
+    start = time.perf_counter()
+    collector.save_data()
+    save_ms = (time.perf_counter() - start) * 1000
+    collector.close_journal()
+
+    # Latency on a fresh collector so every session is new again
+    latency_dir = os.path.join(rundir, 'latency')
+    os.makedirs(latency_dir, exist_ok=True)
+    samples = handler_latencies(make_collector(latency_dir), traffic)
+
+    return {
+        'devices': device_count,
+        'messages': received,
+        'msgs_per_s': received / elapsed if elapsed > 0 else 0.0,
+        'p50_us': percentile(samples, 0.50),
+        'p99_us': percentile(samples, 0.99),
+        'rss_mb': current_rss_mb(),
+        'rss_growth_mb': current_rss_mb() - rss_before,
+        'save_ms': save_ms,
+        'stats_bytes': os.path.getsize(os.path.join(rundir, collector.stats_file)),
+        'events': len(collector.events)
+    }
+
+
+def median_entry(runs):
+    """Per-metric median of repeated bench_load runs; one noisy run can't fail the check on its own"""
+    entry = {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+    entry['devices'] = runs[0]['devices']
+    entry['runs'] = len(runs)
+    return entry
+
+
+# metric -> True if higher is better
+REGRESSION_METRICS = {'msgs_per_s': True, 'p99_us': False, 'save_ms': False}
+
+
+def find_regressions(results, baseline, threshold):
+    """Compare against a previous run; a metric regresses when it is worse by more than threshold"""
+    base_by_size = {entry['devices']: entry for entry in baseline}
+    regressions = []
+    for entry in results:
+        base = base_by_size.get(entry['devices'])
+        if base is None:
+            continue
+        for metric, higher_is_better in REGRESSION_METRICS.items():
+            old, new = base.get(metric), entry.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -threshold) or (not higher_is_better and change > threshold):
+                regressions.append(f"{metric} at {entry['devices']} devices: {old:.1f} -> {new:.1f} ({change:+.0%})")
+    return regressions
+
+
+def run_micro(args, workdir):
+    print("== deviceId lookup ==")
+    bench_device_lookup(workdir, args.sizes, args.messages)
+    print()
+    print("== topic routing ==")
+    # More sessions per device means fewer repeated topics; the router should not care
+    print(f"{'sessions per device':>18} {'legacy chain msg/s':>20} {'router msg/s':>14} {'speedup':>8}")
+    for sessions in (1, 5, 50):
+        bench_topic_routing(workdir, args.messages * 10, sessions)
+    print()
+    print("== device registry memory ==")
+    bench_registry_memory(workdir, [size for size in args.sizes if size >= 1000] or args.sizes)
+    print()
+    print("== stats payload decoding ==")
+    bench_stats_decode(workdir, args.messages * 5)
+    return 0
+
+
+def run_load(args, workdir):
+    broker = None
+    if args.broker:
+        host, _, port = args.broker.partition(':')
+        broker = (host, int(port or 1883))
+        # Local test brokers speak plain MQTT; the collector reads this when building its client
+        os.environ.setdefault('MQTT_TLS', '0')
+
+    print(f"Median of {args.repeat} runs per fleet size")
+    print(f"{'devices':>8} {'messages':>9} {'msg/s':>9} {'p50 us':>8} {'p99 us':>8} "
+          f"{'RSS MiB':>8} {'save ms':>8} {'stats KiB':>10}")
+    results = []
+    for device_count in args.devices:
+        bench_load(workdir, device_count, args.sessions, broker, 'warmup')  # Imports, allocator and page cache
+        entry = median_entry([bench_load(workdir, device_count, args.sessions, broker, run)
+                              for run in range(args.repeat)])
+        results.append(entry)
+        print(f"{entry['devices']:>8} {entry['messages']:>9} {entry['msgs_per_s']:>9.0f} "
+              f"{entry['p50_us']:>8.1f} {entry['p99_us']:>8.1f} {entry['rss_mb']:>8.1f} "
+              f"{entry['save_ms']:>8.1f} {entry['stats_bytes'] / 1024:>10.1f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}, skipping regression check")
+            return 0
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.threshold)
+        if regressions:
+            print(f"❌ Regressions beyond {args.threshold:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"✅ No regressions beyond {args.threshold:.0%}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ESP32 Stats Collector benchmarks")
+    subparsers = parser.add_subparsers(dest='suite')
+
+    micro = subparsers.add_parser('micro', help="Per-message cost of individual hot paths")
+    micro.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000],
+                       help="Device counts to benchmark")
+    micro.add_argument('--messages', type=int, default=20000,
+                       help="Messages per run")
+
+    load = subparsers.add_parser('load', help="Simulated fleet traffic through the full ingest path")
+    load.add_argument('--devices', type=int, nargs='+', default=[100, 1000, 5000],
+                      help="Fleet sizes to simulate")
+    load.add_argument('--sessions', type=int, default=4,
+                      help="Flashing sessions per device")
+    load.add_argument('--broker', metavar='HOST[:PORT]',
+                      help="Publish through this broker (e.g. a local mosquitto) instead of in-process")
+    load.add_argument('--output', metavar='FILE', help="Write results as JSON")
+    load.add_argument('--baseline', metavar='FILE', help="Fail if results regress against this JSON")
+    load.add_argument('--threshold', type=float, default=0.25,
+                      help="Allowed relative regression before failing")
+    load.add_argument('--repeat', type=int, default=5,
+                      help="Runs per fleet size; results and the regression check use the medians")
+
+    # Without a suite name, run the micro-benchmarks (keeps the original invocation working)
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in subparsers.choices and argv[0] not in ('-h', '--help'):
+        argv = ['micro'] + argv
+    args = parser.parse_args(argv)
+
+    # Keep logging out of the measurements
+    logger.setLevel(logging.WARNING)
+    logging.disable(logging.INFO)
+
+    # Paths from the command line are relative to where we were started
+    for name in ('output', 'baseline'):
+        if getattr(args, name, None):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.suite == 'load':
+            return run_load(args, workdir)
+        return run_micro(args, workdir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Precomputed dashboard payloads for the ESP32 Stats MQTT Collector
+Splits the snapshot into a small summary, fixed-size device pages and an events tail, each minified and pre-gzipped
+"""
+
+import os
+import gzip
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+def encode(payload):
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+class DashboardExporter:
+    """Write view-sized JSON files plus a manifest of content hashes
+
+    Clients fetch manifest.json, then only the files whose hash changed. Device pages follow
+    first-seen order, so a page is only rewritten when one of its own devices changes.
+    """
+
+    def __init__(self, directory='stats-dashboard', page_size=200, events_tail=20):
+        self.directory = directory
+        self.page_size = page_size
+        self.events_tail = events_tail
+        self.hashes = None  # file name -> content hash of what is on disk
+
+    def load_hashes(self):
+        try:
+            with open(os.path.join(self.directory, 'manifest.json'), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            return {name: entry['hash'] for name, entry in manifest.get('files', {}).items()}
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def build(self, devices, events, last_update):
+        """Map of file name -> payload for the current state"""
+        names = list(devices)
+        online = sum(1 for device in devices.values() if device.get('online'))
+        pages = max(1, -(-len(names) // self.page_size))
+        # Pages holding an online device; the live list never needs the others
+        online_pages = sorted({index // self.page_size for index, name in enumerate(names) if devices[name].get('online')})
+
+        files = {
+            'summary.json': {
+                'devices': len(names),
+                'online': online,
+                'flashCount': sum(device.get('flashCount', 0) for device in devices.values()),
+                'eraseCount': sum(device.get('eraseCount', 0) for device in devices.values()),
+                'pages': pages,
+                'onlinePages': online_pages,
+                'pageSize': self.page_size,
+                'lastUpdate': last_update,
+            },
+            'events.json': events[:self.events_tail],
+        }
+        for page in range(pages):
+            chunk = names[page * self.page_size:(page + 1) * self.page_size]
+            files[f'devices-{page}.json'] = {name: devices[name] for name in chunk}
+        return files
+
+    def write(self, devices, events, last_update):
+        """Rewrite changed files and the manifest; returns the number of files written"""
+        os.makedirs(self.directory, exist_ok=True)
+        if self.hashes is None:
+            self.hashes = self.load_hashes()
+
+        manifest = {}
+        written = 0
+        for name, payload in self.build(devices, events, last_update).items():
+            body = encode(payload)
+            digest = hashlib.sha256(body).hexdigest()[:16]
+            manifest[name] = {'hash': digest, 'bytes': len(body)}
+            if self.hashes.get(name) == digest:
+                continue
+
+            path = os.path.join(self.directory, name)
+            self.write_file(path, body)
+            # mtime=0 keeps the gzip bytes identical for identical content
+            self.write_file(f'{path}.gz', gzip.compress(body, compresslevel=9, mtime=0))
+            written += 1
+
+        # Pages left over from a larger registry
+        for name in set(self.hashes) - set(manifest):
+            for path in (os.path.join(self.directory, name), os.path.join(self.directory, f'{name}.gz')):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        self.write_file(os.path.join(self.directory, 'manifest.json'),
+                        encode({'version': MANIFEST_VERSION, 'lastUpdate': last_update, 'files': manifest}))
+        self.hashes = {name: entry['hash'] for name, entry in manifest.items()}
+        return written
+
+    @staticmethod
+    def write_file(path, body):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
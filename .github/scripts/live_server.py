@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Live dashboard fan-out for the ESP32 Stats MQTT Collector
+Serves a snapshot plus coalesced deltas over SSE and WebSocket from collector memory, so viewers need no broker connection
+"""
+
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+import threading
+from itertools import islice
+
+from dashboard_export import encode
+
+logger = logging.getLogger(__name__)
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'  # RFC 6455, section 1.3
+WS_TEXT, WS_CLOSE, WS_PING, WS_PONG = 0x1, 0x8, 0x9, 0xA
+MAX_CLIENT_FRAME = 4096  # Clients only send close/ping/pong
+
+
+def ws_accept(key):
+    """Sec-WebSocket-Accept value for a client's Sec-WebSocket-Key
+
+    >>> ws_accept('dGhlIHNhbXBsZSBub25jZQ==')  # The handshake example from RFC 6455
+    b's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+    """
+    return base64.b64encode(hashlib.sha1(key.encode('latin-1') + WS_GUID).digest())
+
+
+def ws_frame(payload, opcode=WS_TEXT):
+    """One unmasked, unfragmented server-to-client frame"""
+    length = len(payload)
+    if length < 126:
+        header = bytes((0x80 | opcode, length))
+    elif length < 65536:
+        header = bytes((0x80 | opcode, 126)) + length.to_bytes(2, 'big')
+    else:
+        header = bytes((0x80 | opcode, 127)) + length.to_bytes(8, 'big')
+    return header + payload
+
+
+def sse_frame(event, payload):
+    return b'event: ' + event + b'\ndata: ' + payload + b'\n\n'
+
+
+class LiveClient:
+    """One connected viewer; frames wait in a bounded queue until its socket drains"""
+
+    def __init__(self, kind, writer, max_queue):
+        self.kind = kind  # 'sse' or 'ws'
+        self.writer = writer
+        self.queue = asyncio.Queue(max_queue)
+        self.task = None
+
+    def frame(self, event, payload):
+        return ws_frame(payload) if self.kind == 'ws' else sse_frame(event, payload)
+
+    def ping_frame(self):
+        return ws_frame(b'', WS_PING) if self.kind == 'ws' else b': ping\n\n'
+
+    async def pump(self):
+        while True:
+            self.writer.write(await self.queue.get())
+            await self.writer.drain()
+
+
+class LiveServer:
+    """Asyncio HTTP server on its own thread, pushing the collector's state to any number of viewers
+
+    GET /events streams Server-Sent Events, GET /ws is a WebSocket and GET /snapshot returns the
+    current state once. Streams start with a 'snapshot' message and continue with at most one 'delta'
+    per interval (the devices that changed plus new events, newest first). A client whose queue is
+    full because it reads too slowly is disconnected instead of holding frames for it.
+
+    Handlers fill dirty_devices and pending_events while holding the collector's lock, like the
+    SQLite store's buffers.
+    """
+
+    def __init__(self, collector, port, host='127.0.0.1', interval=1.0, max_queue=16, max_clients=1000,
+                 events_tail=50, ping_interval=15):
+        self.collector = collector
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.max_queue = max_queue
+        self.max_clients = max_clients
+        self.events_tail = events_tail  # Events in a snapshot and at most per delta
+        self.ping_interval = ping_interval
+
+        self.dirty_devices = set()
+        self.pending_events = []
+        self.clients = set()
+        self.snapshot_cache = None  # (generation, body); reused by viewers connecting in the same interval
+        self.generation = 0
+
+        self.loop = None
+        self.server = None
+        self.stopping = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.error = None
+
+        metrics = collector.metrics
+        metrics.gauge('live_clients', "Connected live dashboard viewers", fn=lambda: len(self.clients))
+        self.dropped = metrics.counter('live_dropped', "Live viewers disconnected for reading too slowly")
+        self.deltas = metrics.counter('live_deltas', "Delta messages built for live viewers")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='live-http', daemon=True)
+        self.thread.start()
+        self.ready.wait(10)
+        if self.error is not None:
+            logger.error(f"❌ Live server failed to start: {self.error}")
+            return False
+        logger.info(f"📡 Live stats at http://{self.host}:{self.port}/events (SSE) and ws://{self.host}:{self.port}/ws")
+        return True
+
+    def stop(self):
+        if self.loop is not None and self.stopping is not None and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.stopping.set)
+            self.thread.join(5)
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        self.stopping = asyncio.Event()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+
+        last_ping = time.monotonic()
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.broadcast_delta()
+            if time.monotonic() - last_ping >= self.ping_interval:
+                last_ping = time.monotonic()
+                for client in list(self.clients):
+                    self.send(client, client.ping_frame())
+
+        self.server.close()
+        for client in list(self.clients):
+            self.drop(client)
+        # Aborted sockets end every handler's read, so the handlers finish on their own
+        handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if handlers:
+            await asyncio.wait(handlers, timeout=5)
+        await self.server.wait_closed()
+
+    # State
+
+    def take(self):
+        """Changed devices and new events since the last call; None when nothing changed"""
+        collector = self.collector
+        with collector.lock:
+            if not self.dirty_devices and not self.pending_events:
+                return None
+            names, self.dirty_devices = self.dirty_devices, set()
+            events, self.pending_events = self.pending_events, []
+            self.generation += 1
+            if not self.clients:
+                return None
+            devices = {name: collector.device_stats[name].to_dict() for name in names if name in collector.device_stats}
+            last_update = collector.now_iso()
+        return {
+            'type': 'delta',
+            'devices': devices,
+            'events': events[:-self.events_tail - 1:-1],
+            'lastUpdate': last_update,
+        }
+
+    def snapshot(self):
+        """Encoded full state; built at most once per interval however many viewers connect"""
+        if self.snapshot_cache is not None and self.snapshot_cache[0] == self.generation:
+            return self.snapshot_cache[1]
+        collector = self.collector
+        with collector.lock:
+            payload = {
+                'type': 'snapshot',
+                'devices': {name: device.to_dict() for name, device in collector.device_stats.items()},
+                'events': list(islice(collector.events, self.events_tail)),
+                'lastUpdate': collector.now_iso(),
+            }
+        body = encode(payload)
+        self.snapshot_cache = (self.generation, body)
+        return body
+
+    def broadcast_delta(self):
+        delta = self.take()
+        if delta is None:
+            return
+        self.deltas.inc()
+        body = encode(delta)
+        frames = {}
+        for client in list(self.clients):
+            frame = frames.get(client.kind)
+            if frame is None:
+                frame = frames[client.kind] = client.frame(b'delta', body)
+            self.send(client, frame)
+
+    # Clients
+
+    def send(self, client, frame):
+        try:
+            client.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.dropped.inc()
+            logger.warning(f"Dropping slow live viewer ({client.kind}, {client.queue.qsize()} frames queued)")
+            self.drop(client)
+
+    def drop(self, client):
+        self.clients.discard(client)
+        if client.task is not None:
+            client.task.cancel()
+        client.writer.transport.abort()  # close() would wait for a slow viewer to drain its backlog
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+
+        lines = request.decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        method = parts[0]
+        path = parts[1].split('?', 1)[0] if len(parts) > 1 else ''
+
+        if method != 'GET':
+            await self.respond(writer, 405, b'Method Not Allowed')
+        elif path == '/snapshot':
+            await self.respond(writer, 200, self.snapshot(), 'application/json')
+        elif path not in ('/events', '/ws'):
+            await self.respond(writer, 404, b'Not Found')
+        elif len(self.clients) >= self.max_clients:
+            await self.respond(writer, 503, b'Too many viewers')
+        elif path == '/ws':
+            key = headers.get('sec-websocket-key')
+            if headers.get('upgrade', '').lower() != 'websocket' or not key:
+                await self.respond(writer, 400, b'Expected a WebSocket upgrade')
+                return
+            writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                         b'Sec-WebSocket-Accept: ' + ws_accept(key) + b'\r\n\r\n')
+            await self.stream(LiveClient('ws', writer, self.max_queue), reader)
+        else:
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                         b'Access-Control-Allow-Origin: *\r\nX-Accel-Buffering: no\r\n\r\n')
+            await self.stream(LiveClient('sse', writer, self.max_queue), reader)
+
+    async def respond(self, writer, status, body, content_type='text/plain'):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  503: 'Service Unavailable'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+                     f'Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def stream(self, client, reader):
+        """Send the snapshot, then serve queued frames until the viewer leaves or is dropped"""
+        self.clients.add(client)
+        self.send(client, client.frame(b'snapshot', self.snapshot()))
+        client.task = asyncio.ensure_future(client.pump())
+        try:
+            if client.kind == 'ws':
+                await self.read_ws(client, reader)
+            else:
+                await reader.read(1)  # SSE viewers send nothing; this returns when they disconnect
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            if client in self.clients:
+                self.drop(client)
+
+    async def read_ws(self, client, reader):
+        """Answer pings and the closing handshake; anything the viewer sends otherwise is ignored"""
+        while True:
+            first, second = await reader.readexactly(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(await reader.readexactly(8), 'big')
+            if length > MAX_CLIENT_FRAME:
+                raise ValueError('client frame too large')
+            mask = await reader.readexactly(4) if second & 0x80 else bytes(4)
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(await reader.readexactly(length)))
+
+            if opcode == WS_CLOSE:
+                client.writer.write(ws_frame(payload[:2], WS_CLOSE))
+                await client.writer.drain()
+                return
+            if opcode == WS_PING:
+                self.send(client, ws_frame(payload, WS_PONG))
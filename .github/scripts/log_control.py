@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Rate-limited, sampled logging for the ESP32 Stats MQTT Collector
+Per-message log lines go through token buckets and 1-in-N sampling; JSON-lines output runs on a listener thread
+"""
+
+import json
+import time
+import queue
+import logging
+import threading
+import logging.handlers
+
+# category: (sample 1 in N, tokens per second, burst)
+DEFAULT_CATEGORIES = {
+    'message': (1, 20.0, 100),   # 📨 every received message
+    'unusual': (1, 10.0, 50),    # 🚨 non-zero counts, unusual config/status
+    'device': (1, 20.0, 100),    # 📊/📱 per-device counter and presence updates
+    'error': (1, 5.0, 20),       # Malformed payloads and handler exceptions
+}
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class LogCategory:
+    __slots__ = ('name', 'sample', 'bucket', 'seen', 'suppressed', 'suppressed_total')
+
+    def __init__(self, name, sample, rate, burst):
+        self.name = name
+        self.sample = max(1, sample)
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.seen = 0
+        self.suppressed = 0  # Since the last emitted line
+        self.suppressed_total = 0
+
+
+class RateLimitedLogger:
+    """Category-aware front end to a logger; arguments are only formatted when a line is emitted"""
+
+    def __init__(self, logger, categories=None):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.categories = {
+            name: LogCategory(name, *settings)
+            for name, settings in (categories or DEFAULT_CATEGORIES).items()
+        }
+
+    def configure(self, sample=None, rate=None, burst=None, names=None):
+        """Override the sampling/rate settings of some (default: all) categories"""
+        for name in names or self.categories:
+            category = self.categories[name]
+            if sample is not None:
+                category.sample = max(1, sample)
+            if rate is not None or burst is not None:
+                bucket = category.bucket
+                rate = rate if rate is not None else (bucket.rate if bucket else 0)
+                burst = burst if burst is not None else (bucket.burst if bucket else max(1, int(rate)))
+                category.bucket = TokenBucket(rate, burst) if rate > 0 else None
+
+    def log(self, category_name, level, msg, *args, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+
+        category = self.categories[category_name]
+        with self.lock:
+            seen = category.seen
+            category.seen += 1
+            if seen % category.sample or (category.bucket is not None and not category.bucket.take()):
+                category.suppressed += 1
+                category.suppressed_total += 1
+                return
+            suppressed, category.suppressed = category.suppressed, 0
+
+        if suppressed:
+            msg += " (+%d suppressed)"
+            args += (suppressed,)
+        extra = {'category': category_name, 'fields': fields, 'suppressed': suppressed}
+        self.logger.log(level, msg, *args, extra=extra)
+
+    def info(self, category_name, msg, *args, **fields):
+        self.log(category_name, logging.INFO, msg, *args, **fields)
+
+    def suppressed_total(self):
+        return sum(category.suppressed_total for category in self.categories.values())
+
+    def report(self):
+        """Log whatever is still suppressed, e.g. at shutdown"""
+        with self.lock:
+            pending = {name: category.suppressed for name, category in self.categories.items() if category.suppressed}
+            for name in pending:
+                self.categories[name].suppressed = 0
+        for name, count in pending.items():
+            self.logger.info("🔇 %d %s log lines suppressed", count, name,
+                             extra={'category': name, 'fields': {}, 'suppressed': count})
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per record, with the category and structured fields kept separate"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        category = getattr(record, 'category', None)
+        if category is not None:
+            entry['category'] = category
+            entry.update(record.fields)
+            if record.suppressed:
+                entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def start_json_logging(path, root=None):
+    """Move the root logger's handlers behind a QueueHandler and add a JSON-lines file
+
+    Formatting and all stream/file I/O happen on the QueueListener thread; returns the listener.
+    """
+    root = root or logging.getLogger()
+    file_handler = logging.FileHandler(path, encoding='utf-8')
+    file_handler.setFormatter(JsonLinesFormatter())
+
+    handlers = list(root.handlers) + [file_handler]
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Minimal Prometheus/OpenMetrics instrumentation for the ESP32 Stats MQTT Collector
+Counters and histograms are created once and bound up front so the hot path only does arithmetic
+"""
+
+import os
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Handler latencies are in the microsecond to millisecond range
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25, 1.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """A settable value, or a callback evaluated at scrape time"""
+    __slots__ = ('value', 'fn')
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class ConnectionTimer:
+    """Accumulates time spent connected and disconnected"""
+
+    def __init__(self):
+        self.connected = False
+        self.since = time.monotonic()
+        self.totals = {True: 0.0, False: 0.0}
+
+    def mark(self, connected):
+        now = time.monotonic()
+        self.totals[self.connected] += now - self.since
+        self.connected = connected
+        self.since = now
+
+    def seconds(self, connected):
+        total = self.totals[connected]
+        if self.connected == connected:
+            total += time.monotonic() - self.since
+        return total
+
+
+class MetricsRegistry:
+    """Holds named metric families and renders them in the Prometheus text format"""
+
+    def __init__(self, prefix='esp32_collector'):
+        self.prefix = prefix
+        self.families = []  # (name, type, help, [(labels, metric)])
+        self.server = None
+
+    def register(self, name, metric_type, help_text, factory, label_sets=None):
+        """Create one metric per label set; returns the metric, or a dict keyed by the first label value"""
+        if label_sets is None:
+            metric = factory()
+            self.families.append((f'{self.prefix}_{name}', metric_type, help_text, [({}, metric)]))
+            return metric
+
+        children = [(labels, factory()) for labels in label_sets]
+        self.families.append((f'{self.prefix}_{name}', metric_type, help_text, children))
+        return {next(iter(labels.values())): metric for labels, metric in children}
+
+    def counter(self, name, help_text, label_sets=None):
+        return self.register(name, 'counter', help_text, Counter, label_sets)
+
+    def gauge(self, name, help_text, fn=None):
+        return self.register(name, 'gauge', help_text, lambda: Gauge(fn))
+
+    def histogram(self, name, help_text, label_sets=None, bounds=LATENCY_BUCKETS):
+        return self.register(name, 'histogram', help_text, lambda: Histogram(bounds), label_sets)
+
+    def take(self):
+        """Counter and histogram values since the last take, reset to zero, for merging in another process"""
+        values = {}
+        for name, metric_type, help_text, children in self.families:
+            if metric_type == 'counter':
+                values[name] = [metric.value for labels, metric in children]
+                for labels, metric in children:
+                    metric.value = 0
+            elif metric_type == 'histogram':
+                values[name] = [(metric.counts, metric.sum) for labels, metric in children]
+                for labels, metric in children:
+                    metric.counts = [0] * len(metric.counts)
+                    metric.sum = 0.0
+        return values
+
+    def add(self, values):
+        """Fold in values taken from a registry with the same families"""
+        for name, metric_type, help_text, children in self.families:
+            taken = values.get(name)
+            if taken is None:
+                continue
+            for (labels, metric), value in zip(children, taken):
+                if metric_type == 'counter':
+                    metric.value += value
+                else:
+                    counts, total = value
+                    metric.counts = [a + b for a, b in zip(metric.counts, counts)]
+                    metric.sum += total
+
+    def render(self):
+        lines = []
+        for name, metric_type, help_text, children in self.families:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, metric in children:
+                if metric_type == 'counter':
+                    lines.append(f'{name}_total{format_labels(labels)} {metric.value}')
+                elif metric_type == 'gauge':
+                    lines.append(f'{name}{format_labels(labels)} {metric.get()}')
+                else:
+                    cumulative = 0
+                    for bound, count in zip(metric.bounds + (float('inf'),), metric.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{name}_bucket{format_labels({**labels, "le": le})} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {metric.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """Atomically write the current values (for node_exporter's textfile collector)"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Expose /metrics over HTTP from a daemon thread"""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info(f"📈 Metrics available at http://{host}:{self.server.server_address[1]}/metrics")
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
@@ -7,59 +7,445 @@ Collects MQTT messages from HiveMQ and updates stats-data.json
 import os
 import sys
 import json
+import math
+import hashlib
 import time
+import gzip
+import shutil
 import logging
-from datetime import datetime, timezone
+import argparse
+import threading
+import queue
+from collections import namedtuple, OrderedDict, deque
+from datetime import datetime, timezone, timedelta
+import asyncio
 import paho.mqtt.client as mqtt
 import signal
 
+from asyncio_engine import AsyncioCollectorEngine
+from sharded_engine import ShardedCollectorEngine
+from replay import CaptureWriter, replay
+from metrics import MetricsRegistry, ConnectionTimer
+from log_control import RateLimitedLogger, start_json_logging
+from rollups import RollupStore
+from dashboard_export import DashboardExporter
+from sqlite_store import SqliteStore
+from telemetry import TelemetryStore
+from presence import TimerWheel
+from live_server import LiveServer
+from stats_batch import decode_batch, BatchFormatError, OP_FLASH, OP_ERASE, OP_ONLINE, STATUS_SUCCESS
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# What on_message does when the ingest queue is full
+OVERFLOW_POLICIES = ('drop_oldest', 'block', 'drop')
+
+# A topic parsed once: which handlers it goes to plus the ids they need
+TopicRoute = namedtuple('TopicRoute', ['kind', 'device_id', 'session_id', 'leaf', 'topic'])
+_new_route = tuple.__new__  # skips namedtuple's Python-level __new__ on the per-message path
+
+class TopicRouter:
+    """Map topics to the kind of their first matching subscription filter (MQTT +/# semantics)
+
+    Filters are root/section/+/.../leaf, where leaf may also be '+', or a literal prefix
+    followed by '#'. Routing is a split, a lookup on the root and one or two dict lookups on
+    (section, level count, leaf), so unique per-session topics cost the same as repeated ones.
+    """
+
+    def __init__(self, filters):
+        # filters: {subscription filter: kind}, most specific first
+        self.sections = {}  # root -> {(section, levels, leaf): kind}; leaf None for filters ending in '+'
+        self.prefixes = []  # (literal levels before '#', kind)
+        for topic_filter, kind in filters.items():
+            levels = topic_filter.split('/')
+            if levels[-1] == '#':
+                prefix = tuple(levels[:-1])
+                if '+' in prefix or '#' in prefix:
+                    raise ValueError(f"Unsupported filter {topic_filter}: only a literal prefix may precede '#'")
+                self.prefixes.append((prefix, kind))
+                continue
+            if len(levels) < 3 or '+' in levels[:2] or any(level != '+' for level in levels[2:-1]) or '#' in levels:
+                raise ValueError(f"Unsupported filter {topic_filter}: expected root/section/+/.../leaf")
+            leaf = None if levels[-1] == '+' else levels[-1]
+            self.sections.setdefault(levels[0], {}).setdefault((levels[1], len(levels), leaf), kind)
+
+    def route(self, topic):
+        """Return the TopicRoute for topic, or None if no filter matches"""
+        levels = topic.split('/')
+        count = len(levels)
+        kind = None
+        table = self.sections.get(levels[0])
+        if table is not None and count >= 3:
+            kind = table.get((levels[1], count, levels[-1])) or table.get((levels[1], count, None))
+        if kind is None:
+            for prefix, prefix_kind in self.prefixes:
+                # 'a/#' also matches 'a' itself
+                if tuple(levels[:len(prefix)]) == prefix:
+                    kind = prefix_kind
+                    break
+            else:
+                return None
+
+        # pierre/serial/{deviceId}/{sessionId}/{leaf}, pierre/{stats|status}/{deviceId}/{leaf}
+        if count > 4:
+            return _new_route(TopicRoute, (kind, levels[2], levels[3], levels[-1], topic))
+        return _new_route(TopicRoute, (kind, levels[2] if count > 3 else None, None, levels[-1], topic))
+
+class BloomFilter:
+    """Fixed-size Bloom filter; remembers keys evicted from the session store"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+class SessionStore:
+    """Persistent deviceId:sessionId dedup set, bounded by TTL and entry count"""
+
+    def __init__(self, path, ttl=30 * 86400, max_entries=100000, bloom_capacity=0, refresh_after=3600):
+        self.path = path
+        self.bloom_path = os.path.splitext(path)[0] + '.bloom'
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh_after = refresh_after
+        self.sessions = OrderedDict()  # key -> last seen (epoch seconds), least recent first
+        self.bloom = BloomFilter(bloom_capacity) if bloom_capacity else None
+        self.dirty = False
+        self.bloom_dirty = False
+        # No store on disk yet (first run or upgrade): retained sessions are history, not new
+        # operations, until the first save
+        self.seeding = False
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, key, now):
+        """Record a sighting of key; returns True only the first time it is seen"""
+        sessions = self.sessions
+        last_seen = sessions.get(key)
+        if last_seen is not None:
+            # Retained messages re-deliver old sessions on every connect; keep them alive
+            # but don't dirty the file for every sighting
+            if now - last_seen >= self.refresh_after:
+                sessions[key] = now
+                sessions.move_to_end(key)
+                self.dirty = True
+            return False
+
+        if self.bloom is not None and key in self.bloom:
+            return False
+
+        sessions[key] = now
+        self.dirty = True
+        self.evict(now)
+        return True
+
+    def evict(self, now):
+        """Drop expired and over-capacity entries, oldest first"""
+        sessions = self.sessions
+        cutoff = now - self.ttl
+        while sessions:
+            key, last_seen = next(iter(sessions.items()))
+            if last_seen >= cutoff and len(sessions) <= self.max_entries:
+                break
+            sessions.popitem(last=False)
+            self.dirty = True
+            if self.bloom is not None:
+                self.bloom.add(key)
+                self.bloom_dirty = True
+
+    def load(self, now):
+        """Load persisted sessions, dropping anything already expired"""
+        self.seeding = not os.path.exists(self.path)
+        if not self.seeding:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for key, last_seen in sorted(data.get('sessions', {}).items(), key=lambda item: item[1]):
+                self.sessions[key] = last_seen
+
+        if self.bloom is not None and os.path.exists(self.bloom_path):
+            with open(self.bloom_path, 'rb') as f:
+                bits = f.read()
+            # A different capacity means a different layout; start that filter over
+            if len(bits) == len(self.bloom.bits):
+                self.bloom.bits = bytearray(bits)
+
+        self.evict(now)
+        self.dirty = False
+
+    def save(self):
+        """Write the store if it changed since the last save"""
+        if self.dirty:
+            data = {
+                "sessions": {key: int(last_seen) for key, last_seen in self.sessions.items()},
+                "ttl": self.ttl,
+                "version": "1.0"
+            }
+            # Temp file and rename: a truncated store would re-count every retained session
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        self.seeding = False
+
+        if self.bloom is not None and self.bloom_dirty:
+            tmp_path = f'{self.bloom_path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.bloom.bits)
+            os.replace(tmp_path, self.bloom_path)
+            self.bloom_dirty = False
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def ms_from_iso(value):
+    """Parse an ISO 8601 timestamp into epoch milliseconds (exact, no float rounding)"""
+    if not value:
+        return 0
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return (parsed - EPOCH) // timedelta(milliseconds=1)
+
+
+def iso_from_ms(ms):
+    """Epoch milliseconds as an ISO 8601 UTC string in the dashboard's toISOString() format"""
+    return (EPOCH + timedelta(milliseconds=ms)).strftime('%Y-%m-%dT%H:%M:%S.') + f'{ms % 1000:03d}Z'
+
+
+class Device:
+    """One device_stats entry; lastSeen is kept as epoch milliseconds and only formatted when saved"""
+    __slots__ = ('flash_count', 'erase_count', 'last_seen', 'online', 'last_device_id', 'app_version')
+
+    def __init__(self, last_seen, device_id, online=False, flash_count=0, erase_count=0, app_version='unknown'):
+        self.flash_count = flash_count
+        self.erase_count = erase_count
+        self.last_seen = last_seen
+        self.online = online
+        self.last_device_id = sys.intern(device_id) if device_id else device_id
+        self.app_version = sys.intern(app_version) if app_version else app_version
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(ms_from_iso(data.get('lastSeen')), data.get('lastDeviceId'), data.get('online', False),
+                   data.get('flashCount', 0), data.get('eraseCount', 0), data.get('appVersion', 'unknown'))
+
+    def to_dict(self):
+        return {
+            'flashCount': self.flash_count,
+            'eraseCount': self.erase_count,
+            'lastSeen': iso_from_ms(self.last_seen),
+            'online': self.online,
+            'lastDeviceId': self.last_device_id,
+            'appVersion': self.app_version
+        }
+
+    def __repr__(self):
+        return f'Device({self.to_dict()!r})'
+
+    def material(self):
+        """Everything except lastSeen, for telling real changes from presence updates"""
+        return (self.flash_count, self.erase_count, self.online, self.last_device_id, self.app_version)
+
+
 class ESP32StatsCollector:
-    def __init__(self):
-        # MQTT Configuration
-        self.broker_host = "0c1bf62a21e94682adf340b8a2d3fe04.s1.eu.hivemq.cloud"
-        self.broker_port = 8883
+    def __init__(self, persistent_session=False, queue_size=10000,
+                 overflow_policy='drop_oldest', batch_size=500,
+                 session_ttl=30 * 86400, max_sessions=100000, session_bloom=0, log_settings=None,
+                 presence_timeout=120):
+        # MQTT Configuration (overridable, e.g. to point benchmarks at a local broker)
+        self.broker_host = os.getenv('MQTT_BROKER_HOST', "0c1bf62a21e94682adf340b8a2d3fe04.s1.eu.hivemq.cloud")
+        self.broker_port = int(os.getenv('MQTT_BROKER_PORT', 8883))
+        self.use_tls = os.getenv('MQTT_TLS', '1') != '0'
         self.username = os.getenv('HIVEMQ_USERNAME')
         self.password = os.getenv('HIVEMQ_PASSWORD')
 
-        # Topics to subscribe - based on actual Android app behavior
-        self.topics = [
-            'pierre/serial/+/+/info',   # Device info (name|battery)
-            'pierre/serial/+/+/count',  # Operation counts
-            'pierre/serial/+/+/status', # Connection status
-            'pierre/serial/+/+/config', # Configuration
-            'pierre/stats/+/+',         # Legacy stats messages (just in case)
-            'pierre/status/+/+',        # Device online/offline
-            'pierre/#'                  # Complete wildcard for debugging
-        ]
+        # Topic kinds - based on actual Android app behavior
+        # Each filter maps to the kind of message it carries; first match wins
+        self.topics = {
+            'pierre/serial/+/+/info': 'info',            # Device info (name|battery)
+            'pierre/serial/+/+/count': 'count',          # Operation counts
+            'pierre/serial/+/+/status': 'serial_status', # Connection status
+            'pierre/serial/+/+/config': 'config',        # Configuration
+            'pierre/stats/+/batch': 'stats_batch',       # Many operations per message (stats_batch.py)
+            'pierre/stats/+/+': 'stats',                 # Legacy stats messages (just in case)
+            'pierre/status/+/+': 'status',               # Device online/offline
+            'pierre/#': 'other'                          # Complete wildcard for debugging
+        }
+        self.router = TopicRouter(self.topics)
+        # One broker subscription; the router sorts messages by kind locally. Subscribing to every
+        # filter above would get each message delivered once per overlapping filter.
+        self.subscriptions = ['pierre/#']
+        self.binary_kinds = {'stats_batch'}  # Handlers get the raw payload bytes
+        self.handlers = {
+            'info': (self.handle_info_message, self.handle_session_tracking),
+            'count': (self.handle_count_message,),
+            'serial_status': (self.handle_serial_status_message,),
+            'config': (self.handle_config_message,),
+            'stats': (self.handle_stats_message,),
+            'stats_batch': (self.handle_stats_batch,),
+            'status': (self.handle_status_message,),
+            'other': ()
+        }
 
         # Data storage
         self.stats_file = 'stats-data.json'
         self.device_stats = {}
-        self.events = []
         self.max_events = 100
+        self.events = deque(maxlen=self.max_events)  # Newest first
+
+        # Append-only event journal keeps the full history; stats-data.json is a periodic snapshot
+        self.journal_file = 'stats-events.jsonl'
+        self.journal = None
+        self.pending_events = []
+        self.journal_batch_size = 256
+        self.journal_max_bytes = 8 * 1024 * 1024
+        self.last_snapshot = 0.0
+
+        # Reverse lookups so handlers don't scan device_stats per message
+        self.device_index = {}     # deviceId -> device name
+
+        # Session tracking for flash/erase operations, persisted across runs
+        self.session_store = SessionStore('stats-sessions.json', ttl=session_ttl,
+                                          max_entries=max_sessions, bloom_capacity=session_bloom)
 
-        # Session tracking for flash/erase operations
-        self.known_sessions = set()  # Track seen session IDs
+        # Minute/hour/day flash and erase history per device (see rollups.py)
+        self.rollups = RollupStore('stats-rollups.json')
+
+        # Small per-view files for the dashboard next to the full snapshot (None disables)
+        self.dashboard = DashboardExporter('stats-dashboard')
+
+        # Battery and config samples with a fleet summary per snapshot (needs NumPy, see telemetry.py)
+        self.telemetry = TelemetryStore('stats-telemetry.json', 'stats-telemetry.npz')
+
+        # Devices that go quiet without an offline message expire after presence_timeout seconds (0 disables)
+        self.presence = TimerWheel(presence_timeout) if presence_timeout else None
+        self.presence_timeout = presence_timeout
+        self.presence_offline = set()  # Taken offline by the timeout; traffic brings them back
+        self.presence_interval = 5  # Seconds between expiry passes in the run loops
+        self.presence_hold_until = None  # Periodic passes expire nothing before this (see expire_stale_devices)
+
+        # Optional full-history SQLite store (see sqlite_store.py); written on journal flushes
+        self.store = None
+        # Optional live fan-out to dashboards (see live_server.py); fed the same way as the store
+        self.live = None
+
+        # Time source for everything handlers record; replay swaps in the capture's timestamps
+        self.clock = time.time
+
+        # Capture of raw traffic for offline replay (see replay.py)
+        self.recorder = None
 
         # Connection tracking
         self.connected = False
         self.messages_received = 0
         self.data_changed = False
+        self.message_time = self.clock()  # Receive time of the message being processed
+        self.message_ms = int(self.message_time * 1000)
+        self.message_retained = False  # Delivered from the broker's retained store, not live
+
+        # Snapshot dirty tracking: which devices changed since the last write, and what was written
+        self.dirty_devices = set()
+        self.events_changed = False
+        self.saved_devices = {}       # device name -> Device.material() as last written
+        self.skip_last_seen_only = False
+        self.snapshot_max_dirty = 0   # Snapshot early once this many devices are dirty (0 disables)
+
+        # Guards device_stats/events between the MQTT thread and periodic flushes
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.connected_event = threading.Event()
+
+        # Ingest queue: on_message only enqueues, one worker thread does the processing
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.message_queue = queue.Queue(maxsize=queue_size)
+        self.overflow_policy = overflow_policy
+        self.batch_size = batch_size
+        self.workers = []
+        self.messages_dropped = 0
+        self.queue_high_watermark = 0
+        self.max_queue_lag = 0.0
+
+        # Per-message log lines are sampled and rate limited by category
+        self.log = RateLimitedLogger(logger)
+        if log_settings:
+            self.log.configure(**log_settings)
+
+        # Metrics: every metric is created here so the hot path only touches bound objects
+        self.metrics = MetricsRegistry()
+        self.metrics_textfile = None
+        self.message_counters = self.metrics.counter(
+            'messages', "Messages processed, by topic kind",
+            [{'kind': kind} for kind in dict.fromkeys(self.topics.values())])
+        handler_names = dict.fromkeys(handler.__name__ for handlers in self.handlers.values() for handler in handlers)
+        self.handler_latency = self.metrics.histogram(
+            'handler_seconds', "Time spent in each message handler",
+            [{'handler': name} for name in handler_names])
+        self.parse_errors = self.metrics.counter('parse_errors', "Payloads that could not be decoded or parsed")
+        self.json_errors = self.metrics.counter('json_errors', "Stats payloads with invalid JSON")
+        self.handler_errors = self.metrics.counter('handler_errors', "Unexpected exceptions raised in handlers")
+        self.presence_expired = self.metrics.counter('presence_expired', "Devices marked offline by the presence timeout")
+        self.connects = self.metrics.counter('connects', "Successful broker connections; reconnects are connects - 1")
+        self.disconnects = self.metrics.counter('disconnects', "Broker disconnections")
+        self.connection_timer = ConnectionTimer()
+        self.metrics.gauge('connected_seconds', "Time spent connected to the broker",
+                           lambda: self.connection_timer.seconds(True))
+        self.metrics.gauge('disconnected_seconds', "Time spent disconnected from the broker",
+                           lambda: self.connection_timer.seconds(False))
+        self.metrics.gauge('messages_received', "Messages received from the broker", lambda: self.messages_received)
+        self.metrics.gauge('messages_dropped', "Messages dropped by the queue overflow policy", lambda: self.messages_dropped)
+        self.metrics.gauge('queue_depth', "Messages waiting for a worker", lambda: self.message_queue.qsize())
+        self.metrics.gauge('log_suppressed', "Log lines dropped by sampling or rate limits",
+                           self.log.suppressed_total)
+        self.save_latency = self.metrics.histogram('save_seconds', "save_data duration",
+                                                   bounds=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+        self.save_bytes = self.metrics.counter('save_bytes', "Bytes written by save_data")
+        self.dispatch_table = {
+            kind: tuple((handler, self.handler_latency[handler.__name__]) for handler in handlers)
+            for kind, handlers in self.handlers.items()
+        }
 
         # Load existing data
         self.load_existing_data()
 
         # Load known sessions from existing data to avoid double-counting
         self.load_known_sessions()
+        self.rollups.load()
+        self.telemetry.load()
+        if self.presence is not None:
+            # Timers run from when each device was last heard, so silence spans runs
+            for device_name, device in self.device_stats.items():
+                if device.online:
+                    self.presence.touch(device_name, device.last_seen / 1000)
 
         # MQTT Client setup
-        self.client = mqtt.Client(client_id=f"server-collector-{int(time.time())}")
+        # A persistent session needs a stable client id so the broker can resume it
+        if persistent_session:
+            client_id = os.getenv('COLLECTOR_CLIENT_ID', 'server-collector')
+        else:
+            client_id = f"server-collector-{int(time.time())}"
+        self.client_id = client_id
+        self.client = mqtt.Client(client_id=client_id, clean_session=not persistent_session)
         self.client.username_pw_set(self.username, self.password)
-        self.client.tls_set()
+        if self.use_tls:
+            self.client.tls_set()
 
         # Callbacks
         self.client.on_connect = self.on_connect
@@ -73,72 +459,303 @@ class ESP32StatsCollector:
                 with open(self.stats_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
 
-                self.device_stats = data.get('devices', {})
-                self.events = data.get('events', [])
-
-                # Convert string dates back to datetime objects for processing
-                for device_name, device_data in self.device_stats.items():
-                    if 'lastSeen' in device_data:
-                        device_data['lastSeen'] = device_data['lastSeen']
+                self.device_stats = {
+                    sys.intern(name): Device.from_dict(device) for name, device in data.get('devices', {}).items()
+                }
+                self.events = deque(data.get('events', []), maxlen=self.max_events)
 
                 for event in self.events:
                     if 'timestamp' in event:
                         event['timestamp'] = event['timestamp']
 
+                self.rebuild_device_index()
+                self.saved_devices = {name: device.material() for name, device in self.device_stats.items()}
+
                 logger.info(f"Loaded {len(self.device_stats)} devices, {len(self.events)} events")
             else:
                 logger.info("No existing stats file found, starting fresh")
         except Exception as e:
             logger.error(f"Error loading existing data: {e}")
 
+    def now_iso(self, ts=None):
+        """ts (default: the current time from self.clock) as an ISO 8601 UTC string"""
+        return datetime.fromtimestamp(self.clock() if ts is None else ts, timezone.utc).isoformat()
+
+    def touch_device(self, device_name, device_id, online=False):
+        """Return the named device, creating it if needed, with lastSeen set to the message time"""
+        device = self.device_stats.get(device_name)
+        if device is None:
+            device = self.device_stats[sys.intern(device_name)] = Device(self.message_ms, device_id, online)
+        else:
+            device.last_seen = self.message_ms
+        # Retained deliveries are old news, not a sign the device is still there
+        if self.presence is not None and not self.message_retained:
+            self.presence.touch(device_name, self.message_time)
+            if device_name in self.presence_offline:
+                self.presence_offline.discard(device_name)
+                device.online = True
+                self.add_event('info', f'{device_name} is back online', device_name)
+                self.mark_changed(device_name)
+        if self.live is not None:
+            self.live.dirty_devices.add(device_name)  # lastSeen moved; viewers get it with the next delta
+        return device
+
+    def track_presence(self, device_name, online):
+        """Arm the presence timer for an online device; an explicit offline needs no timer.
+
+        Returns False when the status must not change the device: a retained online for a
+        device the timeout took offline.
+        """
+        if self.presence is None:
+            return True
+        if self.message_retained:
+            # Old news, as in touch_device: no re-arm. A device it brings online still gets a
+            # timer, running from when the device was last actually heard
+            if device_name in self.presence_offline:
+                return not online
+            if online and device_name not in self.presence.deadlines:
+                self.presence.touch(device_name, self.device_stats[device_name].last_seen / 1000)
+            return True
+        self.presence_offline.discard(device_name)
+        if online:
+            self.presence.touch(device_name, self.message_time)
+        else:
+            self.presence.forget(device_name)
+        return True
+
+    def expire_stale_devices(self, final=False):
+        """Mark devices offline whose presence timer ran out; returns how many went offline
+
+        Periodic passes expire nothing during the first timeout after the first pass, so devices
+        loaded as online get to speak before their (lastSeen based) timers count. The pass at the
+        end of a run (final) skips that wait: whoever stayed silent all run is taken offline.
+        """
+        if self.presence is None:
+            return 0
+        with self.lock:
+            now = self.message_time = self.clock()
+            self.message_ms = int(now * 1000)
+            if self.presence_hold_until is None:
+                self.presence_hold_until = now + self.presence_timeout
+            if not final and now < self.presence_hold_until:
+                return 0
+            expired = 0
+            for device_name in self.presence.advance(now):
+                device = self.device_stats.get(device_name)
+                if device is None or not device.online:
+                    continue
+                device.online = False
+                self.presence_offline.add(device_name)
+                self.add_event('info', f'{device_name} went offline (no messages for {self.presence_timeout}s)', device_name)
+                self.mark_changed(device_name)
+                expired += 1
+        if expired:
+            self.presence_expired.inc(expired)
+            logger.info(f"⏲️ {expired} devices went offline after {self.presence_timeout}s without messages")
+        return expired
+
+    def rebuild_device_index(self):
+        """Rebuild the deviceId -> device name index from device_stats"""
+        # A deviceId shared by several devices belongs to the one seen most recently, the same
+        # rule bind_device_id follows while messages arrive (it runs right after touch_device)
+        index = {}
+        for device_name, device in self.device_stats.items():
+            device_id = device.last_device_id
+            if not device_id:
+                continue
+            current = index.get(device_id)
+            if current is None or device.last_seen >= self.device_stats[current].last_seen:
+                index[device_id] = device_name
+        self.device_index = index
+
+    def bind_device_id(self, device_name, device_id):
+        """Set lastDeviceId on a device and point the reverse index at it; the latest binding wins"""
+        device = self.device_stats[device_name]
+        previous_id = device.last_device_id
+        if previous_id == device_id:
+            self.device_index[previous_id] = device_name
+            return
+        if self.device_index.get(previous_id) == device_name:
+            del self.device_index[previous_id]
+        device_id = device.last_device_id = sys.intern(device_id)
+        self.device_index[device_id] = device_name
+
     def load_known_sessions(self):
-        """Load known sessions from existing data to avoid re-counting"""
+        """Load known sessions from the session store to avoid re-counting"""
         try:
-            # For now, we'll start fresh each time but with a time-based filter
-            # Only count sessions that are "recent" (within last 10 minutes)
-            from datetime import datetime, timedelta, timezone
-            cutoff_time = datetime.now(timezone.utc) - timedelta(minutes=10)
-
-            # In a real implementation, we'd save/load session IDs from a file
-            # For now, we use a time-based approach to avoid old sessions
-            self.session_cutoff = cutoff_time
-            logger.info(f"Session tracking cutoff time: {cutoff_time.isoformat()}")
+            self.session_store.load(time.time())
+            logger.info(f"Loaded {len(self.session_store)} known sessions")
 
         except Exception as e:
             logger.error(f"Error loading known sessions: {e}")
 
+    def mark_changed(self, device_name):
+        """Record that a device changed since the last snapshot"""
+        self.dirty_devices.add(device_name)
+        if self.store is not None:
+            self.store.dirty_devices.add(device_name)
+        if self.live is not None:
+            self.live.dirty_devices.add(device_name)
+        self.data_changed = True
+
+    def has_material_changes(self):
+        """True if anything other than lastSeen timestamps changed since the last snapshot"""
+        if self.events_changed:
+            return True
+        saved = self.saved_devices
+        for name in self.dirty_devices:
+            device = self.device_stats.get(name)
+            if device is None or name not in saved or device.material() != saved[name]:
+                return True
+        return False
+
+    def snapshot_due(self, snapshot_interval):
+        """Coalesce snapshots: write on the time threshold, or early once enough devices are dirty"""
+        if not self.data_changed:
+            return False
+        if time.time() - self.last_snapshot >= snapshot_interval:
+            return True
+        return bool(self.snapshot_max_dirty) and len(self.dirty_devices) >= self.snapshot_max_dirty
+
     def save_data(self):
-        """Save current stats to JSON file"""
+        """Save current stats to JSON file; True on success, including when there was nothing to write"""
         if not self.data_changed:
             logger.info("No data changes, skipping save")
-            return
+            return True
 
         try:
-            data = {
-                "devices": self.device_stats,
-                "events": self.events[:self.max_events],  # Keep only latest events
-                "lastUpdate": datetime.now(timezone.utc).isoformat(),
-                "version": "1.0"
-            }
-
-            with open(self.stats_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            start = time.perf_counter()
+            with self.lock:
+                last_seen_only = self.skip_last_seen_only and not self.has_material_changes()
+                if last_seen_only:
+                    # Keep the devices dirty; their lastSeen rides along with the next real change.
+                    # The dashboard and telemetry carry timestamps too, so they wait for it as well;
+                    # sessions and rollups only change with real traffic and are still saved below
+                    logger.info(f"Only lastSeen changed on {len(self.dirty_devices)} devices, "
+                                f"skipping {self.stats_file}, telemetry and the dashboard")
+                else:
+                    devices = {name: device.to_dict() for name, device in self.device_stats.items()}
+                    data = {
+                        "devices": devices,
+                        "events": list(self.events),  # Latest events; full history is in the journal
+                        "lastUpdate": self.now_iso(),
+                        "version": "1.0"
+                    }
 
+                    # Write a temp file and rename it so a crash never leaves a truncated stats file
+                    tmp_file = f'{self.stats_file}.tmp'
+                    with open(tmp_file, 'w', encoding='utf-8') as f:
+                        json.dump(data, f, indent=2, ensure_ascii=False)
+                        self.save_bytes.inc(f.tell())
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_file, self.stats_file)
+
+                    for name in self.dirty_devices:
+                        device = self.device_stats.get(name)
+                        if device is None:
+                            self.saved_devices.pop(name, None)
+                        else:
+                            self.saved_devices[name] = device.material()
+                    self.dirty_devices.clear()
+                    self.events_changed = False
+
+                self.session_store.save()
+                rollups_body = self.rollups.encode()
+                if not last_seen_only:
+                    self.telemetry.save(self.clock())
+                    if self.dashboard is not None:
+                        self.dashboard.write(devices, data['events'], data['lastUpdate'])
+                self.data_changed = False
+                self.last_snapshot = time.time()
+
+            # Only the changed devices were encoded under the lock; the write doesn't need it
+            self.rollups.write(rollups_body)
+            self.save_latency.observe(time.perf_counter() - start)
             logger.info(f"Stats saved: {len(self.device_stats)} devices, {len(self.events)} events")
-            self.data_changed = False
             return True
         except Exception as e:
             logger.error(f"Error saving data: {e}")
             return False
 
+    def flush_journal(self, include_store=True):
+        """Append pending events to the journal with a single write and fsync"""
+        if include_store:
+            self.flush_store()
+
+        with self.lock:
+            if not self.pending_events or not self.journal_file:
+                return
+
+            try:
+                if self.journal is None:
+                    self.journal = open(self.journal_file, 'a', encoding='utf-8')
+
+                self.journal.write(''.join(
+                    json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n'
+                    for event in self.pending_events
+                ))
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+                self.pending_events = []
+
+                if self.journal.tell() >= self.journal_max_bytes:
+                    self.compact_journal()
+
+            except Exception as e:
+                logger.error(f"Error writing event journal: {e}")
+
+    def flush_store(self):
+        """Write buffered rows to the SQLite store in one transaction, outside the lock"""
+        if self.store is None:
+            return
+        with self.lock:
+            batch = self.store.take(self.device_stats)
+        self.store.write(batch)
+
+    def compact_journal(self):
+        """Move the current journal into a gzip archive segment and start a new one"""
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+            if not os.path.exists(self.journal_file):
+                return
+
+            stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+            base, ext = os.path.splitext(self.journal_file)
+            archive_file = f"{base}-{stamp}{ext}.gz"
+            suffix = 1
+            while os.path.exists(archive_file):
+                archive_file = f"{base}-{stamp}-{suffix}{ext}.gz"
+                suffix += 1
+
+            with open(self.journal_file, 'rb') as src, gzip.open(archive_file, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.journal_file)
+
+            logger.info(f"📦 Event journal archived to {archive_file}")
+
+    def close_journal(self):
+        """Flush and close the event journal"""
+        with self.lock:
+            self.flush_journal()
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
     def on_connect(self, client, userdata, flags, rc):
         """Called when MQTT client connects"""
         if rc == 0:
             self.connected = True
+            self.connected_event.set()
+            self.connects.inc()
+            self.connection_timer.mark(True)
             logger.info("✅ Connected to HiveMQ")
 
             # Subscribe to topics
-            for topic in self.topics:
+            for topic in self.subscriptions:
                 client.subscribe(topic, qos=0)
                 logger.info(f"📡 Subscribed to {topic}")
         else:
@@ -147,328 +764,426 @@ class ESP32StatsCollector:
     def on_disconnect(self, client, userdata, rc):
         """Called when MQTT client disconnects"""
         self.connected = False
+        self.connected_event.clear()
+        self.disconnects.inc()
+        self.connection_timer.mark(False)
         logger.info("📴 Disconnected from MQTT broker")
 
     def on_message(self, client, userdata, msg):
-        """Process received MQTT message"""
+        """Queue received MQTT message; runs on paho's network thread so it must stay cheap"""
+        self.messages_received += 1
+        item = (msg.topic, msg.payload, time.time(), msg.retain)
+
         try:
-            topic = msg.topic
-            payload = msg.payload.decode('utf-8')
-            self.messages_received += 1
+            self.message_queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow_policy == 'block':
+                self.message_queue.put(item)
+            elif self.overflow_policy == 'drop_oldest':
+                while True:
+                    try:
+                        self.message_queue.get_nowait()
+                        self.messages_dropped += 1
+                    except queue.Empty:
+                        pass
+                    try:
+                        self.message_queue.put_nowait(item)
+                        break
+                    except queue.Full:
+                        continue
+            else:
+                self.messages_dropped += 1
+
+        depth = self.message_queue.qsize()
+        if depth > self.queue_high_watermark:
+            self.queue_high_watermark = depth
+
+    def start_workers(self):
+        """Start the thread that drains the ingest queue
+
+        Handlers run under self.lock, so a second thread would add no parallelism and could apply
+        consecutive batches out of order (e.g. connected/disconnected); --shards uses more cores.
+        """
+        worker = threading.Thread(target=self.worker_loop, name="collector-worker", daemon=True)
+        worker.start()
+        self.workers.append(worker)
+
+    def stop_workers(self):
+        """Process everything still queued, then stop the worker threads"""
+        for _ in self.workers:
+            self.message_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def worker_loop(self):
+        """Drain the ingest queue in batches, holding the state lock once per batch"""
+        while True:
+            item = self.message_queue.get()
+            batch = [item]
+            while item is not None and len(batch) < self.batch_size:
+                try:
+                    item = self.message_queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
 
-            logger.info(f"📨 [{self.messages_received}] {topic}: {payload}")
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
 
-            # Log potentially interesting patterns that might indicate operations
-            if '/count' in topic and payload != '0':
-                logger.info(f"🚨 NON-ZERO COUNT DETECTED: {topic} = {payload}")
-            if '/config' in topic and 'BUFFER' not in payload:
-                logger.info(f"🚨 UNUSUAL CONFIG: {topic} = {payload}")
-            if '/status' in topic and payload not in ['connected', 'disconnected']:
-                logger.info(f"🚨 UNUSUAL STATUS: {topic} = {payload}")
-
-            if topic.startswith('pierre/stats/'):
-                self.handle_stats_message(topic, payload)
-            elif '/count' in topic:
-                self.handle_count_message(topic, payload)
-            elif '/status' in topic and 'pierre/serial/' in topic:
-                self.handle_serial_status_message(topic, payload)
-            elif topic.startswith('pierre/status/'):
-                self.handle_status_message(topic, payload)
-            elif '/info' in topic:
-                self.handle_info_message(topic, payload)
-                # NEW: Track sessions as operations
-                self.handle_session_tracking(topic, payload)
+            if batch:
+                lag = time.time() - batch[0][2]
+                if lag > self.max_queue_lag:
+                    self.max_queue_lag = lag
+
+                with self.lock:
+                    for topic, payload, recv_ts, retained in batch:
+                        self.process_message(topic, payload, recv_ts, retained)
+
+            if stopping:
+                return
+
+    def process_message(self, topic, payload, recv_ts=None, retained=False):
+        """Process a received MQTT message; caller holds self.lock"""
+        try:
+            # One clock read per message; handlers use message_time/message_ms
+            now = self.message_time = recv_ts if recv_ts is not None else self.clock()
+            self.message_ms = int(now * 1000)
+            self.message_retained = retained
+
+            if self.recorder is not None:
+                self.recorder.write(now, topic, payload, retained)
+
+            route = self.router.route(topic)
+            if route is None:
+                return
 
+            log = self.log
+            kind = route.kind
+            if kind in self.binary_kinds:
+                log.info('message', "📨 %s: %d bytes", topic, len(payload), topic=topic, kind=kind)
+            else:
+                payload = payload.decode('utf-8')
+                log.info('message', "📨 %s: %s", topic, payload, topic=topic, kind=kind)
+
+            # Log potentially interesting patterns that might indicate operations
+            if kind == 'count' and payload != '0':
+                log.info('unusual', "🚨 NON-ZERO COUNT DETECTED: %s = %s", topic, payload, topic=topic, kind=kind)
+            elif kind == 'config' and 'BUFFER' not in payload:
+                log.info('unusual', "🚨 UNUSUAL CONFIG: %s = %s", topic, payload, topic=topic, kind=kind)
+            elif kind in ('serial_status', 'status') and payload not in ['connected', 'disconnected']:
+                log.info('unusual', "🚨 UNUSUAL STATUS: %s = %s", topic, payload, topic=topic, kind=kind)
+
+            self.message_counters[kind].inc()
+            for handler, latency in self.dispatch_table[kind]:
+                start = time.perf_counter()
+                handler(route, payload)
+                latency.observe(time.perf_counter() - start)
+
+        except UnicodeDecodeError:
+            self.parse_errors.inc()
+            self.log.log('error', logging.ERROR, "Undecodable payload on %s", topic, topic=topic)
         except Exception as e:
-            logger.error(f"Error processing message {topic}: {e}")
+            self.handler_errors.inc()
+            self.log.log('error', logging.ERROR, "Error processing message %s: %s", topic, e, topic=topic)
 
-    def handle_stats_message(self, topic, payload):
+    def handle_stats_message(self, route, payload):
         """Handle stats messages (flash/erase operations)"""
         try:
             # Topic format: pierre/stats/{deviceId}/{operation}
-            parts = topic.split('/')
-            if len(parts) < 4:
-                return
+            self.apply_stats_event(route.device_id, route.leaf, json.loads(payload))
 
-            device_id = parts[2]
-            operation = parts[3]  # flash or erase
-
-            data = json.loads(payload)
-            device_name = data.get('device_name', f'Device {device_id}')
-            event_type = data.get('event', '')
-
-            # Initialize device if not exists
-            if device_name not in self.device_stats:
-                self.device_stats[device_name] = {
-                    'flashCount': 0,
-                    'eraseCount': 0,
-                    'lastSeen': datetime.now(timezone.utc).isoformat(),
-                    'online': False,
-                    'lastDeviceId': device_id,
-                    'appVersion': 'unknown'
-                }
+        except json.JSONDecodeError:
+            self.json_errors.inc()
+            self.log.log('error', logging.ERROR, "Invalid JSON in stats message: %s", payload)
+        except Exception as e:
+            self.handler_errors.inc()
+            logger.error(f"Error handling stats message: {e}")
+
+    def apply_stats_event(self, device_id, operation, data):
+        """Apply one JSON stats event; operation is the topic leaf (flash or erase)"""
+        device_name = data.get('device_name', f'Device {device_id}')
+        event_type = data.get('event', '')
+
+        # Initialize device if not exists
+        device = self.touch_device(device_name, device_id)
+        self.bind_device_id(device_name, device_id)
 
-            device = self.device_stats[device_name]
-            device['lastSeen'] = datetime.now(timezone.utc).isoformat()
-            device['lastDeviceId'] = device_id
+        if data.get('app_version'):
+            device.app_version = sys.intern(data['app_version'])
 
-            if data.get('app_version'):
-                device['appVersion'] = data['app_version']
+        # Update counters
+        if operation == 'flash' and event_type == 'flash_success':
+            device.flash_count += 1
+            self.rollups.record(device_name, 'flash', self.message_time)
+            self.add_event('flash', f'{device_name} completed flash operation', device_name)
+            self.log.info('device', "📊 %s flash count: %d", device_name, device.flash_count, device=device_name)
 
-            # Update counters
-            if operation == 'flash' and event_type == 'flash_success':
-                device['flashCount'] += 1
-                self.add_event('flash', f'{device_name} completed flash operation', device_name)
-                logger.info(f"📊 {device_name} flash count: {device['flashCount']}")
+        elif operation == 'erase' and event_type == 'erase_success':
+            device.erase_count += 1
+            self.rollups.record(device_name, 'erase', self.message_time)
+            self.add_event('erase', f'{device_name} completed erase operation', device_name)
+            self.log.info('device', "📊 %s erase count: %d", device_name, device.erase_count, device=device_name)
 
-            elif operation == 'erase' and event_type == 'erase_success':
-                device['eraseCount'] += 1
-                self.add_event('erase', f'{device_name} completed erase operation', device_name)
-                logger.info(f"📊 {device_name} erase count: {device['eraseCount']}")
+        elif event_type == 'device_online':
+            self.add_event('info', f'{device_name} connected', device_name)
 
-            elif event_type == 'device_online':
+        self.mark_changed(device_name)
+
+    def handle_stats_batch(self, route, payload):
+        """Handle batched stats: many operations from one device in one message"""
+        try:
+            # Topic format: pierre/stats/{deviceId}/batch
+            # Payload: binary batch (stats_batch.py), or JSON (one stats object or a list of them)
+            device_id = route.device_id
+            if payload[:1] in (b'{', b'['):
+                data = json.loads(payload)
+                for item in data if isinstance(data, list) else [data]:
+                    # The JSON events name their operation: flash_success -> flash
+                    self.apply_stats_event(device_id, item.get('event', '').split('_', 1)[0], item)
+                return
+
+            device_name, app_version, records = decode_batch(payload)
+            device = self.touch_device(device_name, device_id)
+            self.bind_device_id(device_name, device_id)
+            if app_version:
+                device.app_version = sys.intern(app_version)
+
+            # One pass over the records; counters, rollups and events are updated per operation, not per record
+            flashes = {}  # age -> operations
+            erases = {}
+            online = False
+            for operation, status, repeat, age in records:
+                if status != STATUS_SUCCESS:
+                    continue
+                if operation == OP_FLASH:
+                    flashes[age] = flashes.get(age, 0) + repeat
+                elif operation == OP_ERASE:
+                    erases[age] = erases.get(age, 0) + repeat
+                elif operation == OP_ONLINE:
+                    online = True
+
+            flash_total = sum(flashes.values())
+            erase_total = sum(erases.values())
+            device.flash_count += flash_total
+            device.erase_count += erase_total
+            for operation, by_age, total in (('flash', flashes, flash_total), ('erase', erases, erase_total)):
+                if not total:
+                    continue
+                # Operations in the same finest rollup bucket are recorded together
+                step = self.rollups.finest_step
+                by_bucket = {}
+                for age, count in by_age.items():
+                    bucket = int((self.message_time - age) // step)
+                    by_bucket[bucket] = by_bucket.get(bucket, 0) + count
+                for bucket, count in by_bucket.items():
+                    self.rollups.record(device_name, operation, bucket * step, count)
+                self.add_event(operation, f'{device_name} completed {total} {operation} operations', device_name,
+                               count=total)
+            if online:
                 self.add_event('info', f'{device_name} connected', device_name)
 
-            self.data_changed = True
+            self.log.info('device', "📊 %s batch: %d flashes, %d erases (totals %d/%d)", device_name, flash_total,
+                          erase_total, device.flash_count, device.erase_count, device=device_name)
+            self.mark_changed(device_name)
 
         except json.JSONDecodeError:
-            logger.error(f"Invalid JSON in stats message: {payload}")
+            self.json_errors.inc()
+            self.log.log('error', logging.ERROR, "Invalid JSON in stats batch on %s", route.topic)
+        except (BatchFormatError, UnicodeDecodeError) as e:
+            self.parse_errors.inc()
+            self.log.log('error', logging.ERROR, "Bad stats batch on %s: %s", route.topic, e, topic=route.topic)
         except Exception as e:
-            logger.error(f"Error handling stats message: {e}")
+            self.handler_errors.inc()
+            logger.error(f"Error handling stats batch: {e}")
 
-    def handle_status_message(self, topic, payload):
+    def handle_status_message(self, route, payload):
         """Handle device online/offline status"""
         try:
             # Topic format: pierre/status/{deviceId}/{online|offline}
-            parts = topic.split('/')
-            if len(parts) < 4:
-                return
-
-            device_id = parts[2]
-            status = parts[3]  # online or offline
+            device_id = route.device_id
+            status = route.leaf  # online or offline
             is_online = (status == 'online')
 
             # Find device by deviceId and update status
-            for device_name, device_data in self.device_stats.items():
-                if device_data.get('lastDeviceId') == device_id:
-                    if device_data['online'] != is_online:
-                        device_data['online'] = is_online
-                        device_data['lastSeen'] = datetime.now(timezone.utc).isoformat()
-
-                        status_msg = "came online" if is_online else "went offline"
-                        self.add_event('info', f'{device_name} {status_msg}', device_name)
-                        logger.info(f"📱 {device_name} is now {'online' if is_online else 'offline'}")
-                        self.data_changed = True
-                    break
+            device_name = self.device_index.get(device_id)
+            if device_name:
+                device_data = self.device_stats[device_name]
+                # Every live status message re-arms the timer, not only the ones that change the state
+                if self.track_presence(device_name, is_online) and device_data.online != is_online:
+                    device_data.online = is_online
+                    device_data.last_seen = self.message_ms
+
+                    status_msg = "came online" if is_online else "went offline"
+                    self.add_event('info', f'{device_name} {status_msg}', device_name)
+                    self.log.info('device', "📱 %s is now %s", device_name, status, device=device_name)
+                    self.mark_changed(device_name)
 
         except Exception as e:
+            self.handler_errors.inc()
             logger.error(f"Error handling status message: {e}")
 
-    def handle_info_message(self, topic, payload):
+    def handle_info_message(self, route, payload):
         """Handle device info messages"""
         try:
             # Topic format: pierre/serial/{deviceId}/{sessionId}/info
             # Payload format: "Device Name|BatteryLevel"
-            parts = topic.split('/')
-            if len(parts) < 4:
-                return
-
-            device_id = parts[2]
+            device_id = route.device_id
 
             if '|' in payload:
                 device_name, battery = payload.split('|', 1)
 
                 # Update or create device entry
-                if device_name not in self.device_stats:
-                    self.device_stats[device_name] = {
-                        'flashCount': 0,
-                        'eraseCount': 0,
-                        'lastSeen': datetime.now(timezone.utc).isoformat(),
-                        'online': False,
-                        'lastDeviceId': device_id,
-                        'appVersion': 'unknown'
-                    }
+                device = self.touch_device(device_name, device_id)
+                self.bind_device_id(device_name, device_id)
 
-                device = self.device_stats[device_name]
-                device['lastSeen'] = datetime.now(timezone.utc).isoformat()
-                device['lastDeviceId'] = device_id
+                self.log.info('device', "📱 Device info: %s (Battery: %s%%)", device_name, battery,
+                              device=device_name, battery=battery)
+                self.mark_changed(device_name)
 
-                logger.info(f"📱 Device info: {device_name} (Battery: {battery}%)")
-                self.data_changed = True
+                # A retained info is replayed on every connect and stamped with the receive time,
+                # so it would pass old readings off as fresh samples
+                if not self.message_retained:
+                    try:
+                        self.telemetry.record_battery(device_name, self.message_time, float(battery))
+                    except ValueError:
+                        self.parse_errors.inc()
 
         except Exception as e:
+            self.handler_errors.inc()
             logger.error(f"Error handling info message: {e}")
 
-    def handle_count_message(self, topic, payload):
-        """Handle count messages from pierre/serial/{deviceId}/{sessionId}/count"""
+    def handle_config_message(self, route, payload):
+        """Keep config samples from pierre/serial/{deviceId}/{sessionId}/config for the fleet summary"""
         try:
-            # Topic format: pierre/serial/{deviceId}/{sessionId}/count
-            parts = topic.split('/')
-            if len(parts) < 4:
-                return
-
-            device_id = parts[2]
-            session_id = parts[3]
-            count_value = int(payload)
-
-            # Find device by deviceId to get the device name
-            device_name = None
-            for name, device_data in self.device_stats.items():
-                if device_data.get('lastDeviceId') == device_id:
-                    device_name = name
-                    break
-
-            if not device_name:
-                device_name = f'Device {device_id}'
-
-            # Skip count tracking - we use session tracking instead
-            return
+            if self.message_retained:
+                return  # Old config replayed on connect; not a sample taken now
+            device_id = route.device_id
+            device_name = self.device_index.get(device_id) or f'Device {device_id}'
+            self.telemetry.record_config(device_name, self.message_time, payload.strip())
 
-            if count_value > previous_count:
-                # Initialize device if not exists
-                if device_name not in self.device_stats:
-                    self.device_stats[device_name] = {
-                        'flashCount': 0,
-                        'eraseCount': 0,
-                        'lastSeen': datetime.now(timezone.utc).isoformat(),
-                        'online': False,
-                        'lastDeviceId': device_id,
-                        'appVersion': 'unknown'
-                    }
-
-                device = self.device_stats[device_name]
-                device['lastSeen'] = datetime.now(timezone.utc).isoformat()
-                device['lastDeviceId'] = device_id
-
-                # Assume count increases are flash operations (most common)
-                operations_performed = count_value - previous_count
-                device['flashCount'] += operations_performed
-
-                self.add_event('flash', f'{device_name} completed {operations_performed} flash operation(s)', device_name)
-                logger.info(f"📊 {device_name} count increased from {previous_count} to {count_value} (+{operations_performed} flash ops)")
-                self.data_changed = True
-
-            # Update stored count
-            self.device_counts[device_key] = count_value
+        except Exception as e:
+            self.handler_errors.inc()
+            logger.error(f"Error handling config message: {e}")
 
+    def handle_count_message(self, route, payload):
+        """Handle count messages from pierre/serial/{deviceId}/{sessionId}/count"""
+        try:
+            # Topic format: pierre/serial/{deviceId}/{sessionId}/count
+            # Only validated: flash/erase totals come from session tracking, not from counts
+            int(payload)
         except ValueError:
-            logger.error(f"Invalid count value: {payload}")
+            self.parse_errors.inc()
+            self.log.log('error', logging.ERROR, "Invalid count value: %s", payload)
         except Exception as e:
+            self.handler_errors.inc()
             logger.error(f"Error handling count message: {e}")
 
-    def handle_serial_status_message(self, topic, payload):
+    def handle_serial_status_message(self, route, payload):
         """Handle status messages from pierre/serial/{deviceId}/{sessionId}/status"""
         try:
             # Topic format: pierre/serial/{deviceId}/{sessionId}/status
-            parts = topic.split('/')
-            if len(parts) < 4:
-                return
-
-            device_id = parts[2]
-            session_id = parts[3]
+            device_id = route.device_id
             status = payload.strip()  # connected, disconnected, etc.
             is_online = (status == 'connected')
 
             # Find device by deviceId and update status
-            device_name = None
-            for name, device_data in self.device_stats.items():
-                if device_data.get('lastDeviceId') == device_id:
-                    device_name = name
-                    if device_data['online'] != is_online:
-                        device_data['online'] = is_online
-                        device_data['lastSeen'] = datetime.now(timezone.utc).isoformat()
-
-                        status_msg = "connected" if is_online else "disconnected"
-                        self.add_event('info', f'{device_name} {status_msg}', device_name)
-                        logger.info(f"📱 {device_name} is now {status_msg}")
-
-                        # EXPERIMENTAL: Count disconnections as potential flash/erase operations
-                        if status == 'disconnected':
-                            # Assume disconnection might indicate a completed operation
-                            device_data['flashCount'] += 1
-                            self.add_event('flash', f'{device_name} completed operation (detected via disconnect)', device_name)
-                            logger.info(f"📊 {device_name} flash count incremented due to disconnect (experimental detection)")
-
-                        self.data_changed = True
-                    break
+            device_name = self.device_index.get(device_id)
+            if device_name:
+                device_data = self.device_stats[device_name]
+                # Every live status message re-arms the timer, not only the ones that change the state
+                if self.track_presence(device_name, is_online) and device_data.online != is_online:
+                    device_data.online = is_online
+                    device_data.last_seen = self.message_ms
+
+                    status_msg = "connected" if is_online else "disconnected"
+                    self.add_event('info', f'{device_name} {status_msg}', device_name)
+                    self.log.info('device', "📱 %s is now %s", device_name, status_msg, device=device_name)
+
+                    # EXPERIMENTAL: Count disconnections as potential flash/erase operations
+                    if status == 'disconnected':
+                        # Assume disconnection might indicate a completed operation
+                        device_data.flash_count += 1
+                        self.rollups.record(device_name, 'flash', self.message_time)
+                        self.add_event('flash', f'{device_name} completed operation (detected via disconnect)', device_name)
+                        self.log.info('device', "📊 %s flash count incremented due to disconnect (experimental detection)",
+                                      device_name, device=device_name)
+
+                    self.mark_changed(device_name)
 
             # Log unknown devices that disconnect/connect
             if not device_name and status == 'disconnected':
-                unknown_device = f'Device {device_id}'
-                logger.info(f"🔍 Unknown device {unknown_device} disconnected - potential operation")
+                self.log.info('device', "🔍 Unknown device Device %s disconnected - potential operation", device_id,
+                              device_id=device_id)
 
         except Exception as e:
+            self.handler_errors.inc()
             logger.error(f"Error handling serial status message: {e}")
 
-    def handle_session_tracking(self, topic, payload):
+    def handle_session_tracking(self, route, payload):
         """Track new sessions as ESP32 operations"""
         try:
             # Topic format: pierre/serial/{deviceId}/{sessionId}/info
-            parts = topic.split('/')
-            if len(parts) < 4:
-                return
-
-            device_id = parts[2]
-            session_id = parts[3]
+            device_id = route.device_id
+            session_id = route.session_id
             session_key = f"{device_id}:{session_id}"
 
-            # Check if this is a new session AND it's very recent
-            current_time = datetime.now(timezone.utc)
-
-            if session_key not in self.known_sessions:
-                self.known_sessions.add(session_key)
-
-                # Only count as operation if this might be a real new session
-                # Skip if we've already seen many sessions (likely existing data)
-                if len(self.known_sessions) > 5:
-                    logger.info(f"🔕 Skipping session {session_key} - too many sessions detected (likely old data)")
-                    return
-
+            # Retained messages replay old sessions on every connect; the store remembers them.
+            # Without a store yet, retained sessions only seed it.
+            session_store = self.session_store
+            if session_store.add(session_key, self.message_time) and not (session_store.seeding and self.message_retained):
                 # Extract device name from payload
                 device_name = payload.split('|')[0] if '|' in payload else f'Device {device_id}'
+                if self.store is not None:
+                    self.store.pending_sessions.append((session_key, device_id, session_id, device_name, self.message_time))
 
                 # Initialize device if not exists
-                if device_name not in self.device_stats:
-                    self.device_stats[device_name] = {
-                        'flashCount': 0,
-                        'eraseCount': 0,
-                        'lastSeen': datetime.now(timezone.utc).isoformat(),
-                        'online': True,
-                        'lastDeviceId': device_id,
-                        'appVersion': 'unknown'
-                    }
-
-                device = self.device_stats[device_name]
-                device['lastSeen'] = datetime.now(timezone.utc).isoformat()
-                device['lastDeviceId'] = device_id
-                device['online'] = True
+                device = self.touch_device(device_name, device_id, online=True)
+                self.bind_device_id(device_name, device_id)
+                device.online = True
 
                 # Count new session as a flash operation (most common)
-                device['flashCount'] += 1
+                device.flash_count += 1
+                self.rollups.record(device_name, 'flash', self.message_time)
                 self.add_event('flash', f'{device_name} started new session (auto-detected operation)', device_name)
 
-                logger.info(f"🆕 NEW SESSION DETECTED: {session_key} - {device_name}")
-                logger.info(f"📊 {device_name} flash count: {device['flashCount']}")
+                self.log.info('device', "🆕 NEW SESSION DETECTED: %s - %s", session_key, device_name,
+                              device=device_name, session=session_key)
+                self.log.info('device', "📊 %s flash count: %d", device_name, device.flash_count, device=device_name)
 
-                self.data_changed = True
+                self.mark_changed(device_name)
 
         except Exception as e:
+            self.handler_errors.inc()
             logger.error(f"Error handling session tracking: {e}")
 
-    def add_event(self, event_type, message, device_name):
-        """Add event to the events list"""
+    def add_event(self, event_type, message, device_name, count=1):
+        """Add event to the events list; count > 1 stands for that many identical operations"""
         event = {
             'type': event_type,
             'message': message,
             'deviceName': device_name,
-            'timestamp': datetime.now(timezone.utc).isoformat()
+            'timestamp': self.now_iso(self.message_time)
         }
-
-        self.events.insert(0, event)  # Add to beginning
-
-        # Keep only latest events
-        if len(self.events) > self.max_events:
-            self.events = self.events[:self.max_events]
+        if count != 1:
+            event['count'] = count
+        self.record_event(event)
+
+    def record_event(self, event):
+        """Put an already built event into the ring and the journal queue"""
+        self.events.appendleft(event)  # Newest first; the deque drops the oldest
+        self.pending_events.append(event)
+        self.events_changed = True
+        if self.store is not None:
+            self.store.pending_events.append(event)
+        if self.live is not None:
+            self.live.pending_events.append(event)
+
+        # Without a journal file (e.g. in a shard) pending events are collected by the owner
+        # The SQLite store waits for the periodic flush so it never runs on the message path
+        if self.journal_file and len(self.pending_events) >= self.journal_batch_size:
+            self.flush_journal(include_store=False)
 
     def collect_for_duration(self, duration_seconds=50):  # 50 seconds
         """Collect messages for specified duration"""
@@ -476,17 +1191,15 @@ class ESP32StatsCollector:
 
         # Connect to broker
         try:
+            self.start_workers()
             self.client.connect(self.broker_host, self.broker_port, 60)
             self.client.loop_start()
 
             # Wait for connection
-            timeout = 10
-            while not self.connected and timeout > 0:
-                time.sleep(1)
-                timeout -= 1
-
-            if not self.connected:
+            if not self.connected_event.wait(10):
                 logger.error("❌ Failed to connect to MQTT broker within timeout")
+                self.client.loop_stop()
+                self.stop_workers()
                 return False
 
             # Collect messages for specified duration
@@ -496,43 +1209,241 @@ class ESP32StatsCollector:
 
                 # Log progress every 10 seconds
                 elapsed = int(time.time() - start_time)
+                # Loaded devices get a timeout to speak first; the final pass below catches the silent ones
+                if elapsed % self.presence_interval == 0 and elapsed > 0:
+                    self.expire_stale_devices()
                 if elapsed % 10 == 0 and elapsed > 0:
-                    logger.info(f"⏱️ Progress: {elapsed}s elapsed, {self.messages_received} messages received")
-
-            logger.info(f"✅ Collection completed: {self.messages_received} messages received")
+                    logger.info(f"⏱️ Progress: {elapsed}s elapsed, {self.messages_received} messages received, "
+                                f"queue {self.message_queue.qsize()}, dropped {self.messages_dropped}")
 
             # Disconnect
             self.client.loop_stop()
             self.client.disconnect()
+            self.stop_workers()
+            self.expire_stale_devices(final=True)
+
+            logger.info(f"✅ Collection completed: {self.messages_received} messages received, "
+                        f"{self.messages_dropped} dropped, peak queue depth {self.queue_high_watermark}")
 
             # Save data if any changes
+            self.close_journal()
             return self.save_data()
 
         except Exception as e:
             logger.error(f"❌ Error during collection: {e}")
+            self.stop_workers()
+            self.close_journal()
+            return False
+
+    def export_metrics(self):
+        """Write the metrics textfile, if one was configured"""
+        if self.metrics_textfile:
+            try:
+                self.metrics.write_textfile(self.metrics_textfile)
+            except Exception as e:
+                logger.error(f"Error writing metrics textfile: {e}")
+
+    def request_shutdown(self, signum=None, frame=None):
+        """Signal handler: ask the daemon loop to flush and exit"""
+        logger.info(f"🛑 Shutdown requested (signal {signum})")
+        self.stop_event.set()
+
+    def run_daemon(self, flush_interval=60, snapshot_interval=300):
+        """Hold a single connection open and flush stats periodically until stopped"""
+        logger.info(f"🚀 Starting MQTT collector daemon (flush every {flush_interval}s)...")
+
+        signal.signal(signal.SIGTERM, self.request_shutdown)
+        signal.signal(signal.SIGINT, self.request_shutdown)
+
+        try:
+            # paho reconnects on its own from the loop thread; on_connect resubscribes
+            self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+            self.start_workers()
+            self.client.connect(self.broker_host, self.broker_port, 60)
+            self.client.loop_start()
+
+            last_flush = time.time()
+            while not self.stop_event.wait(min(flush_interval, self.presence_interval)):
+                self.expire_stale_devices()
+                if time.time() - last_flush < flush_interval:
+                    continue
+                last_flush = time.time()
+                logger.info(f"⏱️ Daemon alive: {self.messages_received} messages received, connected={self.connected}, "
+                            f"queue {self.message_queue.qsize()} (peak {self.queue_high_watermark}), "
+                            f"dropped {self.messages_dropped}, max lag {self.max_queue_lag:.3f}s")
+                self.flush_journal()
+                if self.snapshot_due(snapshot_interval):
+                    self.save_data()
+                self.export_metrics()
+
+            logger.info(f"✅ Daemon stopping: {self.messages_received} messages received")
+
+            self.client.disconnect()
+            self.client.loop_stop()
+            self.stop_workers()
+            self.expire_stale_devices(final=True)
+
+            # Final flush; save_data is also True when there was nothing to write
+            self.close_journal()
+            return self.save_data()
+
+        except Exception as e:
+            logger.error(f"❌ Error in collector daemon: {e}")
+            self.stop_workers()
+            self.close_journal()
+            self.save_data()
             return False
 
 def main():
     """Main function"""
+    parser = argparse.ArgumentParser(description="ESP32 Stats MQTT Collector")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep one persistent connection open until SIGTERM instead of a single burst")
+    parser.add_argument('--duration', type=int, default=50,
+                        help="Collection time in seconds for a single (non-daemon) run")
+    parser.add_argument('--flush-interval', type=int, default=60,
+                        help="Seconds between event journal flushes in daemon mode")
+    parser.add_argument('--snapshot-interval', type=int, default=300,
+                        help="Seconds between stats-data.json snapshots in daemon mode")
+    parser.add_argument('--skip-lastseen-only', action='store_true',
+                        help="Don't rewrite stats-data.json, telemetry or the dashboard when only lastSeen timestamps changed")
+    parser.add_argument('--snapshot-max-dirty', type=int, default=0,
+                        help="Snapshot before --snapshot-interval once this many devices changed (0 disables)")
+    parser.add_argument('--queue-size', type=int, default=10000,
+                        help="Maximum number of received messages waiting for processing")
+    parser.add_argument('--overflow-policy', choices=OVERFLOW_POLICIES, default='drop_oldest',
+                        help="What to do with a message when the queue is full")
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread',
+                        help="Run the MQTT client on paho's loop thread or on an asyncio event loop")
+    parser.add_argument('--connections', type=int, default=1,
+                        help="Broker connections for the asyncio engine (needs --share-group when > 1)")
+    parser.add_argument('--share-group', default=None,
+                        help="Use MQTT 5 shared subscriptions ($share/<group>/...) with this group name")
+    parser.add_argument('--shards', type=int, default=0,
+                        help="Partition message handling by deviceId across this many worker processes")
+    parser.add_argument('--record', metavar='FILE',
+                        help="Capture all received traffic to a gzip capture file")
+    parser.add_argument('--replay', metavar='FILE', nargs='+',
+                        help="Feed capture files through the handlers offline instead of connecting")
+    parser.add_argument('--replay-output', metavar='DIR',
+                        help="Replay from empty state into this new (or empty) directory instead of the current one")
+    parser.add_argument('--verbose-replay', action='store_true',
+                        help="Keep per-message INFO logs during --replay")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="Serve Prometheus/OpenMetrics text on 127.0.0.1:<port>/metrics (0 disables)")
+    parser.add_argument('--metrics-textfile', metavar='FILE',
+                        help="Also write the metrics to this file (node_exporter textfile format)")
+    parser.add_argument('--log-sample', type=int, default=1,
+                        help="Log only 1 in N per-message (📨) lines")
+    parser.add_argument('--log-rate', type=float, default=None,
+                        help="Per-category limit on per-message log lines per second (0 disables the limit)")
+    parser.add_argument('--log-burst', type=int, default=None,
+                        help="Per-category burst allowance for --log-rate")
+    parser.add_argument('--log-json', metavar='FILE',
+                        help="Also write logs as JSON lines; all log I/O then runs on a listener thread")
+    parser.add_argument('--live-port', type=int, default=0,
+                        help="Serve live stats to dashboards over SSE (/events) and WebSocket (/ws) on this port (0 disables)")
+    parser.add_argument('--live-host', default='127.0.0.1',
+                        help="Address for --live-port")
+    parser.add_argument('--live-interval', type=float, default=1.0,
+                        help="Seconds between coalesced live deltas")
+    parser.add_argument('--sqlite', metavar='FILE',
+                        help="Also keep full device/session/event history in this SQLite database")
+    parser.add_argument('--session-ttl-days', type=float, default=30,
+                        help="Forget sessions not seen for this many days")
+    parser.add_argument('--max-sessions', type=int, default=100000,
+                        help="Maximum number of sessions kept in the dedup store")
+    parser.add_argument('--session-bloom', type=int, default=0,
+                        help="Capacity of a Bloom filter remembering evicted sessions (0 disables)")
+    parser.add_argument('--presence-timeout', type=int, default=120,
+                        help="Mark a device offline after this many seconds without messages (0 disables)")
+    args = parser.parse_args()
+
+    log_listener = start_json_logging(args.log_json) if args.log_json else None
     logger.info("🚀 ESP32 Stats Collector starting...")
 
     # Validate environment variables
-    if not os.getenv('HIVEMQ_USERNAME') or not os.getenv('HIVEMQ_PASSWORD'):
+    if not args.replay and (not os.getenv('HIVEMQ_USERNAME') or not os.getenv('HIVEMQ_PASSWORD')):
         logger.error("❌ Missing HIVEMQ credentials in environment variables")
         sys.exit(1)
 
-    # Create collector and run
-    collector = ESP32StatsCollector()
+    if args.replay and args.replay_output:
+        # State files are relative to the working directory, so a fresh one means fresh state
+        if os.path.isdir(args.replay_output) and os.listdir(args.replay_output):
+            logger.error(f"❌ --replay-output {args.replay_output} is not empty")
+            sys.exit(1)
+        args.replay = [os.path.abspath(path) for path in args.replay]
+        os.makedirs(args.replay_output, exist_ok=True)
+        os.chdir(args.replay_output)
 
-    # Collect for 50 seconds (runs every minute)
-    success = collector.collect_for_duration(50)
+    # Create collector and run
+    collector_options = {
+        'persistent_session': args.daemon,
+        'queue_size': args.queue_size,
+        'overflow_policy': args.overflow_policy,
+        'session_ttl': int(args.session_ttl_days * 86400),
+        'max_sessions': args.max_sessions,
+        'session_bloom': args.session_bloom,
+        'presence_timeout': args.presence_timeout,
+        'log_settings': {'rate': args.log_rate, 'burst': args.log_burst}
+    }
+    collector = ESP32StatsCollector(**collector_options)
+    collector.log.configure(sample=args.log_sample, names=['message'])
+    collector.skip_last_seen_only = args.skip_lastseen_only
+    collector.snapshot_max_dirty = args.snapshot_max_dirty
+    if args.record:
+        collector.recorder = CaptureWriter(args.record)
+    if args.metrics_port:
+        collector.metrics.serve(args.metrics_port)
+    collector.metrics_textfile = args.metrics_textfile
+    if args.sqlite:
+        collector.store = SqliteStore(args.sqlite)
+    if args.live_port:
+        collector.live = LiveServer(collector, args.live_port, host=args.live_host, interval=args.live_interval)
+        if not collector.live.start():
+            collector.live = None
+
+    if args.replay:
+        if not args.replay_output:
+            collector.journal_file = None  # Replayed events are not new; keep them out of the live journal
+        replay(collector, args.replay, verbose=args.verbose_replay)
+        collector.close_journal()
+        collector.data_changed = True
+        success = collector.save_data()
+    elif args.shards > 1:
+        engine = ShardedCollectorEngine(collector, collector_options, shards=args.shards)
+        success = engine.run(None if args.daemon else args.duration,
+                             flush_interval=args.flush_interval, snapshot_interval=args.snapshot_interval)
+    elif args.engine == 'asyncio':
+        engine = AsyncioCollectorEngine(collector, connections=args.connections,
+                                        share_group=args.share_group, client_id=collector.client_id,
+                                        persistent_session=args.daemon)
+        success = asyncio.run(engine.run(None if args.daemon else args.duration,
+                                         args.flush_interval, args.snapshot_interval))
+    elif args.daemon:
+        success = collector.run_daemon(args.flush_interval, args.snapshot_interval)
+    else:
+        # Collect for 50 seconds (runs every minute)
+        success = collector.collect_for_duration(args.duration)
+
+    if collector.recorder is not None:
+        collector.recorder.close()
+    collector.export_metrics()
+    collector.metrics.shutdown()
+    if collector.live is not None:
+        collector.live.stop()
+    if collector.store is not None:
+        collector.flush_store()
+        collector.store.close()
+    collector.log.report()
 
     if success:
         logger.info("✅ Stats collection completed successfully")
-        sys.exit(0)
     else:
         logger.error("❌ Stats collection failed")
-        sys.exit(1)
+    if log_listener is not None:
+        log_listener.stop()
+    sys.exit(0 if success else 1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
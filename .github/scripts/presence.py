@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Presence tracking for the ESP32 Stats MQTT Collector
+A hashed timer wheel expires devices that went quiet without an explicit offline message
+"""
+
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    """Deadlines bucketed by tick; refreshes are O(1) and expiry only visits the slots that came due
+
+    Each key sits in one slot. A refresh that pushes the deadline out only updates deadlines; when
+    the old slot comes due the key moves on to the slot of its real deadline.
+    """
+
+    def __init__(self, timeout, tick=1.0, slots=512):
+        self.tick = tick
+        self.timeout_ticks = max(1, math.ceil(timeout / tick))
+        self.slot_count = max(slots, self.timeout_ticks + 1)
+        self.slots = [set() for _ in range(self.slot_count)]
+        self.deadlines = {}   # key -> tick at which it expires
+        self.current = None   # Last tick that was processed
+
+    def touch(self, key, now):
+        """(Re)arm key to expire timeout seconds after now"""
+        deadline = int(now // self.tick) + self.timeout_ticks
+        if self.current is not None and deadline <= self.current:
+            deadline = self.current + 1  # Already overdue (e.g. loaded from disk): due on the next advance
+        previous = self.deadlines.get(key)
+        self.deadlines[key] = deadline
+        # A later deadline is picked up when the slot the key is in comes due; an earlier one
+        # (out-of-order timestamps) would be missed there, so the key joins that slot too
+        if previous is None or deadline < previous:
+            self.slots[deadline % self.slot_count].add(key)
+
+    def forget(self, key):
+        self.deadlines.pop(key, None)
+
+    def advance(self, now):
+        """Process every tick up to now; returns the keys that expired, as one batch"""
+        target = int(now // self.tick)
+        if self.current is None:
+            # Keys armed before the first call may sit in any slot; visit each once
+            self.current = target - self.slot_count
+        if target <= self.current:
+            return []
+
+        expired = []
+        deadlines, slots, slot_count = self.deadlines, self.slots, self.slot_count
+        # After a long gap every slot is due once; no need to walk the same slot twice
+        first = max(self.current + 1, target - slot_count + 1)
+        for tick in range(first, target + 1):
+            index = tick % slot_count
+            slot = slots[index]
+            if not slot:
+                continue
+            keep = set()
+            for key in slot:
+                deadline = deadlines.get(key)
+                if deadline is None:
+                    continue  # Forgotten
+                if deadline <= target:
+                    expired.append(key)
+                    del deadlines[key]
+                elif deadline % slot_count == index:
+                    keep.add(key)  # Due in a later revolution
+                else:
+                    slots[deadline % slot_count].add(key)  # Refreshed since it was slotted here
+            slots[index] = keep
+        self.current = target
+        return expired
+
+    def __len__(self):
+        return len(self.deadlines)
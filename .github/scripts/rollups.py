@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Time-bucketed flash/erase history for the ESP32 Stats MQTT Collector
+Fixed-size ring buffers per device, operation and resolution, saved as compact columnar JSON
+"""
+
+import os
+import json
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# name: (bucket seconds, buckets kept) - coarser series outlive the finer ones
+RESOLUTIONS = {
+    'minute': (60, 24 * 60),      # 1 day
+    'hour': (3600, 30 * 24),      # 30 days
+    'day': (86400, 2 * 366),      # 2 years
+}
+
+ROLLUP_VERSION = 1
+
+
+class RollupSeries:
+    """Counts per bucket in a ring buffer; bucket b lives in slot b % size"""
+    __slots__ = ('step', 'size', 'counts', 'latest')
+
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.counts = array('I', bytes(4 * size))
+        self.latest = None  # Newest bucket number (epoch // step)
+
+    def add(self, ts, amount=1):
+        bucket = int(ts // self.step)
+        latest = self.latest
+        if latest is None:
+            self.latest = bucket
+        elif bucket > latest:
+            # Buckets skipped since the last write fall out of retention
+            counts, size = self.counts, self.size
+            for skipped in range(latest + 1, min(bucket, latest + size) + 1):
+                counts[skipped % size] = 0
+            self.latest = bucket
+        elif bucket <= latest - self.size:
+            return False  # Older than the retention window
+        self.counts[bucket % self.size] += amount
+        return True
+
+    def window(self):
+        """Counts for buckets latest - size + 1 .. latest, oldest first, as an array"""
+        start = (self.latest + 1) % self.size
+        return self.counts[start:] + self.counts[:start]
+
+    def buckets(self, end=None):
+        """(first bucket, counts oldest first) covering the retention window up to end"""
+        end = self.latest if end is None else end
+        if end is None:
+            return None, []
+        if self.latest is None:
+            return end - self.size + 1, [0] * self.size
+        # Shift the stored window so it ends at end; buckets outside it are empty
+        shift, size = end - self.latest, self.size
+        window = self.window()
+        if shift >= size or shift <= -size:
+            counts = array('I', bytes(4 * size))
+        elif shift >= 0:
+            counts = window[shift:] + array('I', bytes(4 * shift))
+        else:
+            counts = array('I', bytes(4 * -shift)) + window[:size + shift]
+        return end - size + 1, counts.tolist()
+
+    def to_compact(self):
+        if self.latest is None:
+            return None
+        window = self.window()
+        # Leading empty buckets carry no information; find the first non-zero count at C speed
+        raw = window.tobytes()
+        skip = (len(raw) - len(raw.lstrip(b'\0'))) // window.itemsize
+        return {'start': self.latest - self.size + 1 + skip, 'counts': window[skip:].tolist()}
+
+    def load_compact(self, data):
+        self.latest = data['start'] + len(data['counts']) - 1
+        for offset, count in enumerate(data['counts'][-self.size:], max(0, len(data['counts']) - self.size)):
+            self.counts[(data['start'] + offset) % self.size] = count
+
+    def merge(self, other):
+        """Add another series' counts (e.g. from a shard process) into this one"""
+        if self.latest is None:
+            self.counts, self.latest = array('I', other.counts), other.latest
+            return
+        first, counts = other.buckets()
+        if first is None:
+            return
+        for offset, count in enumerate(counts):
+            if count:
+                self.add((first + offset) * self.step, count)
+
+
+class RollupStore:
+    """Per device and operation history at every resolution in RESOLUTIONS"""
+
+    def __init__(self, path='stats-rollups.json', resolutions=RESOLUTIONS):
+        self.path = path
+        self.resolutions = resolutions
+        self.finest_step = min(step for step, _ in resolutions.values())  # Times closer than this share every bucket
+        self.series = {}  # (device_name, operation) -> {resolution: RollupSeries}
+        self.operations = {}  # Every operation name seen, in first-seen order
+        self.dirty = False
+        # Series changed since they were last encoded; every other device reuses its cached JSON
+        self.dirty_keys = set()
+        self.encoded = {}  # device_name -> '"name":{...}' fragment of the saved file
+
+    def new_series(self, key):
+        self.operations.setdefault(key[1])
+        series = self.series[key] = {
+            name: RollupSeries(step, size) for name, (step, size) in self.resolutions.items()
+        }
+        return series
+
+    def record(self, device_name, operation, ts, amount=1):
+        key = (device_name, operation)
+        series = self.series.get(key)
+        if series is None:
+            series = self.new_series(key)
+        for rollup in series.values():
+            rollup.add(ts, amount)
+        self.dirty_keys.add(key)
+        self.dirty = True
+
+    def query(self, device_name, operation, resolution, end_ts=None):
+        """(bucket start timestamps, counts) for a chart; costs O(buckets) regardless of traffic"""
+        series = self.series.get((device_name, operation))
+        if series is None:
+            return [], []
+        rollup = series[resolution]
+        first, counts = rollup.buckets(None if end_ts is None else int(end_ts // rollup.step))
+        if first is None:
+            return [], []
+        return [(first + i) * rollup.step for i in range(len(counts))], counts
+
+    def take_changed(self):
+        """Series recorded into since the last call, for shipping to another process"""
+        changed = {key: self.series[key] for key in self.dirty_keys}
+        self.dirty_keys = set()
+        return changed
+
+    def merge(self, keys, sources):
+        """Rebuild the series for keys as the sum of the same series in several sources (e.g. shard processes)"""
+        for key in keys:
+            target = self.new_series(key)
+            for source in sources:
+                series = source.get(key)
+                if series is not None:
+                    for name, rollup in series.items():
+                        target[name].merge(rollup)
+            self.dirty_keys.add(key)
+        if keys:
+            self.dirty = True
+
+    def compact_device(self, device_name):
+        operations = {}
+        for operation in self.operations:
+            series = self.series.get((device_name, operation))
+            if series is not None:
+                compact = {name: rollup.to_compact() for name, rollup in series.items()}
+                operations[operation] = {name: data for name, data in compact.items() if data}
+        return operations
+
+    def to_compact(self):
+        devices = {}
+        for device_name, operation in self.series:
+            if device_name not in devices:
+                devices[device_name] = self.compact_device(device_name)
+        return {
+            'version': ROLLUP_VERSION,
+            'resolutions': {name: {'step': step, 'size': size} for name, (step, size) in self.resolutions.items()},
+            'devices': devices,
+        }
+
+    def encode(self):
+        """The file contents if anything changed, else None; only changed devices are re-encoded.
+
+        Call with the collector's lock held and hand the result to write() after releasing it.
+        """
+        if not self.dirty or not self.path:
+            return None
+        encoded = self.encoded
+        for device_name in {device_name for device_name, _ in self.dirty_keys}:
+            encoded[device_name] = (json.dumps(device_name, ensure_ascii=False) + ':' +
+                                    json.dumps(self.compact_device(device_name), separators=(',', ':'), ensure_ascii=False))
+        self.dirty_keys = set()
+        self.dirty = False
+        resolutions = {name: {'step': step, 'size': size} for name, (step, size) in self.resolutions.items()}
+        return (f'{{"version":{ROLLUP_VERSION},"resolutions":{json.dumps(resolutions, separators=(",", ":"))},'
+                f'"devices":{{{",".join(encoded.values())}}}}}')
+
+    def write(self, body):
+        """Atomically write what encode() returned; safe without the collector's lock"""
+        if body is None:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(body)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != ROLLUP_VERSION:
+                logger.warning(f"Ignoring {self.path}: unsupported version {data.get('version')}")
+                return
+            for device_name, operations in data.get('devices', {}).items():
+                for operation, compact in operations.items():
+                    series = self.new_series((device_name, operation))
+                    for name, rollup_data in compact.items():
+                        if name in series:
+                            series[name].load_compact(rollup_data)
+            self.dirty_keys = set(self.series)
+            logger.info(f"Loaded rollups for {len(self.series)} device/operation series")
+        except Exception as e:
+            logger.error(f"Error loading rollups: {e}")
+
+    def save(self):
+        """Atomically write the compact file if anything changed"""
+        self.write(self.encode())
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Sharded engine for the ESP32 Stats MQTT Collector
+Partitions messages by deviceId across worker processes and merges their state
+"""
+
+import copy
+import time
+import zlib
+import signal
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def shard_for(device_id, shard_count):
+    """Stable deviceId -> shard mapping (the builtin hash() differs per process)"""
+    return zlib.crc32(device_id.encode('utf-8')) % shard_count
+
+
+def shard_main(collector_class, options, shard_id, shard_count, inbox, outbox):
+    """Worker process: owns the devices and sessions whose deviceId hashes to shard_id"""
+    # The coordinator owns shutdown; a SIGTERM/SIGINT to the process group must not kill shards early
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    collector = collector_class(**options)
+    collector.journal_file = None  # Events go back to the coordinator
+    collector.events.clear()
+
+    collector.device_stats = {
+        name: device for name, device in collector.device_stats.items()
+        if shard_for(device.last_device_id or '', shard_count) == shard_id
+    }
+    collector.rebuild_device_index()
+    if collector.presence is not None:
+        for name in [name for name in collector.presence.deadlines if name not in collector.device_stats]:
+            collector.presence.forget(name)
+    collector.rollups.path = None  # The coordinator merges and saves the history
+    collector.telemetry.path = collector.telemetry.state_path = None
+    if collector.telemetry.enabled:
+        collector.telemetry.merge([])
+    rollups = collector.rollups
+    rollups.series = {key: series for key, series in rollups.series.items() if key[0] in collector.device_stats}
+    rollups.dirty_keys = set(rollups.series)  # The first shipment carries the history loaded at startup
+
+    sessions = collector.session_store.sessions
+    for key in [key for key in sessions if shard_for(key.split(':', 1)[0], shard_count) != shard_id]:
+        del sessions[key]
+
+    sent = {}  # name -> (material, last_seen) as of the last reply
+
+    while True:
+        command, body = inbox.get()
+
+        if command == 'messages':
+            with collector.lock:
+                for topic, payload, recv_ts, retained in body:
+                    collector.process_message(topic, payload, recv_ts, retained)
+            continue
+
+        # 'merge' / 'stop': hand back what changed since the last merge
+        collector.expire_stale_devices(final=command == 'stop')
+        with collector.lock:
+            events, collector.pending_events = collector.pending_events, []
+            # Only devices that changed since the last reply travel; the first reply carries all of them.
+            # Copies, because the queue pickles them on its feeder thread while messages keep arriving
+            changed = {}
+            for name, device in collector.device_stats.items():
+                state = (device.material(), device.last_seen)
+                if sent.get(name) != state:
+                    sent[name] = state
+                    changed[name] = copy.copy(device)
+            # Rollups and telemetry arrays are large; they only travel with snapshot merges,
+            # and only the rollup series recorded into since the last one
+            snapshot = body or command == 'stop'
+            rollups = copy.deepcopy(collector.rollups.take_changed()) if snapshot else None
+            telemetry = collector.telemetry if snapshot else None
+            devices = None
+            if changed or collector.data_changed or snapshot:
+                devices = (changed, rollups, telemetry)
+            collector.data_changed = False
+
+            store = collector.session_store
+            session_state = None
+            if body or command == 'stop':
+                session_state = (dict(store.sessions), bytes(store.bloom.bits) if store.bloom is not None else None)
+
+            # Handlers run here, so the per-kind counters and handler latencies do too
+            outbox.put((shard_id, devices, events, session_state, collector.metrics.take()))
+
+        if command == 'stop':
+            return
+
+
+class ShardedCollectorEngine:
+    """Fan messages out to K shard processes by deviceId; merge their counters into the collector"""
+
+    def __init__(self, collector, options, shards=2, batch_size=256, batch_interval=0.05):
+        self.collector = collector
+        self.options = options
+        self.shard_count = shards
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+        self.inboxes = []
+        self.outbox = None
+        self.processes = []
+        self.buffers = [[] for _ in range(shards)]
+        self.buffer_lock = threading.Lock()
+        self.shard_devices = [{} for _ in range(shards)]
+        self.shard_rollups = [{} for _ in range(shards)]  # Latest copy of each series a shard shipped
+        self.shard_telemetry = [None] * shards
+        self.stop_event = threading.Event()
+        # Shards see the traffic, so they run the presence timers; the coordinator's copy would only go stale
+        collector.presence = None
+
+    def start(self):
+        """Start the shard processes"""
+        collector_class = type(self.collector)
+        self.outbox = multiprocessing.Queue()
+        for shard_id in range(self.shard_count):
+            inbox = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=shard_main, name=f"collector-shard-{shard_id}",
+                args=(collector_class, self.options, shard_id, self.shard_count, inbox, self.outbox),
+                daemon=True)
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+
+    def on_message(self, client, userdata, msg):
+        """paho callback: route to the owning shard's buffer"""
+        collector = self.collector
+        collector.messages_received += 1
+        recv_ts = time.time()
+        if collector.recorder is not None:
+            collector.recorder.write(recv_ts, msg.topic, msg.payload, msg.retain)
+
+        route = collector.router.route(msg.topic)
+        if route is None or route.device_id is None or not collector.handlers.get(route.kind):
+            return
+
+        shard_id = shard_for(route.device_id, self.shard_count)
+        with self.buffer_lock:
+            buffer = self.buffers[shard_id]
+            buffer.append((msg.topic, msg.payload, recv_ts, msg.retain))
+            if len(buffer) >= self.batch_size:
+                self.buffers[shard_id] = []
+                self.inboxes[shard_id].put(('messages', buffer))
+
+    def flush_buffers(self):
+        """Send every partially filled batch to its shard"""
+        with self.buffer_lock:
+            for shard_id, buffer in enumerate(self.buffers):
+                if buffer:
+                    self.buffers[shard_id] = []
+                    self.inboxes[shard_id].put(('messages', buffer))
+
+    def merge(self, command='merge', with_sessions=False):
+        """Collect per-shard state and fold it into the collector's devices, events and sessions"""
+        self.flush_buffers()
+        for inbox in self.inboxes:
+            inbox.put((command, with_sessions))
+
+        replies = [self.outbox.get() for _ in self.inboxes]
+        collector = self.collector
+
+        with collector.lock:
+            changed = False
+            names = set()
+            rollup_keys = set()
+            new_events = []
+            session_states = []
+            for shard_id, devices, events, session_state, metrics in replies:
+                collector.metrics.add(metrics)
+                if devices is not None:
+                    shard_changed, rollups, telemetry = devices
+                    self.shard_devices[shard_id].update(shard_changed)
+                    names.update(shard_changed)
+                    if rollups is not None:
+                        self.shard_rollups[shard_id].update(rollups)
+                        rollup_keys.update(rollups)
+                    if telemetry is not None:
+                        self.shard_telemetry[shard_id] = telemetry
+                    changed = True
+                new_events.extend(events)
+                if session_state is not None:
+                    session_states.append(session_state)
+
+            if changed:
+                # Existing names keep their position so the stats file diffs stay small
+                collector.device_stats.update(self.merge_devices(names))
+                collector.dirty_devices.update(names)
+                if collector.store is not None:
+                    collector.store.dirty_devices.update(names)
+                if collector.live is not None:
+                    collector.live.dirty_devices.update(names)
+                if names:
+                    collector.rebuild_device_index()
+                collector.rollups.merge(rollup_keys, self.shard_rollups)
+                if collector.telemetry.enabled:
+                    collector.telemetry.merge([telemetry for telemetry in self.shard_telemetry if telemetry is not None])
+                collector.data_changed = True
+
+            # Events from different shards interleave; replay them oldest first
+            for event in sorted(new_events, key=lambda event: event.get('timestamp', '')):
+                collector.record_event(event)
+            if new_events:
+                collector.data_changed = True
+
+            if session_states:
+                self.merge_sessions(session_states)
+
+    def merge_devices(self, names):
+        """Combine the shards' entries for names; a name seen under deviceIds in several shards is summed"""
+        merged = {}
+        for devices in self.shard_devices:
+            for name in names:
+                device = devices.get(name)
+                if device is None:
+                    continue
+                current = merged.get(name)
+                if current is None:
+                    merged[name] = copy.copy(device)
+                    continue
+
+                newer, older = (device, current) if device.last_seen > current.last_seen else (current, device)
+                combined = copy.copy(newer)
+                combined.flash_count = current.flash_count + device.flash_count
+                combined.erase_count = current.erase_count + device.erase_count
+                if combined.app_version == 'unknown':
+                    combined.app_version = older.app_version
+                merged[name] = combined
+        return merged
+
+    def merge_sessions(self, session_states):
+        """Rebuild the collector's session store from the shards' slices"""
+        store = self.collector.session_store
+        combined = {}
+        for sessions, bloom_bits in session_states:
+            combined.update(sessions)
+            if store.bloom is not None and bloom_bits is not None:
+                store.bloom.bits = bytearray(a | b for a, b in zip(store.bloom.bits, bloom_bits))
+                store.bloom_dirty = True
+
+        # Shards track sessions; the coordinator only sees them here
+        sqlite_store = self.collector.store
+        if sqlite_store is not None:
+            for key in combined.keys() - store.sessions.keys():
+                device_id, _, session_id = key.partition(':')
+                sqlite_store.pending_sessions.append((key, device_id, session_id, None, combined[key]))
+
+        store.sessions = OrderedDict(sorted(combined.items(), key=lambda item: item[1]))
+        store.dirty = True
+
+    def request_shutdown(self, signum=None, frame=None):
+        logger.info(f"🛑 Shutdown requested (signal {signum})")
+        self.stop_event.set()
+
+    def run(self, duration=None, merge_interval=5, flush_interval=60, snapshot_interval=300):
+        """Collect until duration elapses (or until SIGTERM when duration is None)"""
+        collector = self.collector
+        signal.signal(signal.SIGTERM, self.request_shutdown)
+        signal.signal(signal.SIGINT, self.request_shutdown)
+
+        self.start()
+        logger.info(f"🚀 Started {self.shard_count} shard processes")
+
+        client = collector.client
+        client.on_message = self.on_message
+        try:
+            client.connect(collector.broker_host, collector.broker_port, 60)
+            client.loop_start()
+
+            if not collector.connected_event.wait(10):
+                logger.error("❌ Failed to connect to MQTT broker within timeout")
+                client.loop_stop()
+                self.merge('stop', with_sessions=True)
+                return False
+
+            start = time.time()
+            last_flush = start
+            last_merge = 0.0
+            while not self.stop_event.wait(self.batch_interval):
+                now = time.time()
+                if duration is not None and now - start >= duration:
+                    break
+
+                self.flush_buffers()
+                if now - last_merge >= merge_interval:
+                    self.merge()
+                    last_merge = now
+                if now - last_flush >= flush_interval:
+                    logger.info(f"⏱️ {collector.messages_received} messages received, connected={collector.connected}")
+                    collector.flush_journal()
+                    collector.export_metrics()
+                    last_flush = now
+                if collector.snapshot_due(snapshot_interval):
+                    self.merge(with_sessions=True)
+                    collector.save_data()
+
+            client.disconnect()
+            client.loop_stop()
+
+            self.merge('stop', with_sessions=True)
+            logger.info(f"✅ Collection completed: {collector.messages_received} messages received")
+            collector.close_journal()
+            return collector.save_data()
+
+        except Exception as e:
+            logger.error(f"❌ Error in sharded collector: {e}")
+            return False
+
+        finally:
+            for process in self.processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
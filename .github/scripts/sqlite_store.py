@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+SQLite analytics store for the ESP32 Stats MQTT Collector
+Keeps the full device, session and event history that stats-data.json caps, plus a small report CLI
+"""
+
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    name TEXT PRIMARY KEY,
+    device_id TEXT,
+    flash_count INTEGER NOT NULL DEFAULT 0,
+    erase_count INTEGER NOT NULL DEFAULT 0,
+    last_seen INTEGER,          -- epoch milliseconds
+    online INTEGER NOT NULL DEFAULT 0,
+    app_version TEXT
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    session_key TEXT PRIMARY KEY,
+    device_id TEXT NOT NULL,
+    session_id TEXT,
+    device_name TEXT,
+    ts REAL NOT NULL            -- epoch seconds
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,           -- epoch seconds
+    type TEXT NOT NULL,
+    device_name TEXT,
+    device_id TEXT,
+    message TEXT,
+    count INTEGER NOT NULL DEFAULT 1  -- operations a batched event stands for
+);
+CREATE INDEX IF NOT EXISTS events_device_ts ON events (device_id, ts);
+CREATE INDEX IF NOT EXISTS events_type_ts ON events (type, ts);
+CREATE INDEX IF NOT EXISTS sessions_device_ts ON sessions (device_id, ts);
+"""
+
+
+def epoch_from_iso(value):
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return time.time()
+
+
+class SqliteStore:
+    """Buffers rows in memory and writes them in one transaction per flush
+
+    The collector only appends to the pending lists while it processes messages;
+    the collector's flush_store() calls take() under its lock and write() outside it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        # Databases created before batched events lack the count column
+        if 'count' not in {row[1] for row in self.db.execute('PRAGMA table_info(events)')}:
+            self.db.execute('ALTER TABLE events ADD COLUMN count INTEGER NOT NULL DEFAULT 1')
+        self.pending_events = []    # event dicts as built by the collector
+        self.pending_sessions = []  # (session_key, device_id, session_id, device_name, ts)
+        self.dirty_devices = set()
+
+    def take(self, devices):
+        """Swap out the buffers; call with the collector's lock held"""
+        events, self.pending_events = self.pending_events, []
+        sessions, self.pending_sessions = self.pending_sessions, []
+        device_rows = []
+        for name in self.dirty_devices:
+            device = devices.get(name)
+            if device is not None:
+                device_rows.append((name, device.last_device_id, device.flash_count, device.erase_count,
+                                    device.last_seen, int(device.online), device.app_version))
+        self.dirty_devices = set()
+
+        event_rows = []
+        for event in events:
+            name = event.get('deviceName')
+            device = devices.get(name)
+            event_rows.append((epoch_from_iso(event.get('timestamp')), event.get('type'), name,
+                               device.last_device_id if device is not None else None, event.get('message'),
+                               event.get('count', 1)))
+        return device_rows, sessions, event_rows
+
+    def write(self, batch):
+        """Insert one taken batch in a single transaction"""
+        device_rows, session_rows, event_rows = batch
+        if not (device_rows or session_rows or event_rows):
+            return
+        try:
+            with self.db:
+                self.db.executemany(
+                    'INSERT INTO devices (name, device_id, flash_count, erase_count, last_seen, online, app_version) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET '
+                    'device_id = excluded.device_id, flash_count = excluded.flash_count, '
+                    'erase_count = excluded.erase_count, last_seen = excluded.last_seen, '
+                    'online = excluded.online, app_version = excluded.app_version', device_rows)
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO sessions (session_key, device_id, session_id, device_name, ts) '
+                    'VALUES (?, ?, ?, ?, ?)', session_rows)
+                self.db.executemany(
+                    'INSERT INTO events (ts, type, device_name, device_id, message, count) VALUES (?, ?, ?, ?, ?, ?)',
+                    event_rows)
+        except sqlite3.Error as e:
+            logger.error(f"Error writing to {self.path}: {e}")
+
+    def close(self):
+        self.db.close()
+
+
+# CLI reports; each returns (sql, params)
+def report_flashes(args):
+    group = 'device_id' if args.by == 'device-id' else 'device_name'
+    return (f"SELECT {group}, SUM(count) AS flashes FROM events WHERE type = 'flash' AND ts >= ? "
+            f"GROUP BY {group} ORDER BY flashes DESC LIMIT ?", (time.time() - args.days * 86400, args.limit))
+
+
+def report_sessions(args):
+    if args.device_id:
+        return ("SELECT session_key, device_name, datetime(ts, 'unixepoch') AS started FROM sessions "
+                "WHERE device_id = ? AND ts >= ? ORDER BY ts DESC LIMIT ?",
+                (args.device_id, time.time() - args.days * 86400, args.limit))
+    return ("SELECT device_id, MAX(device_name) AS device_name, COUNT(*) AS sessions FROM sessions WHERE ts >= ? "
+            "GROUP BY device_id ORDER BY sessions DESC LIMIT ?", (time.time() - args.days * 86400, args.limit))
+
+
+def report_events(args):
+    where, params = ['ts >= ?'], [time.time() - args.days * 86400]
+    if args.type:
+        where.append('type = ?')
+        params.append(args.type)
+    if args.device_id:
+        where.append('device_id = ?')
+        params.append(args.device_id)
+    return (f"SELECT datetime(ts, 'unixepoch') AS time, type, device_name, message FROM events "
+            f"WHERE {' AND '.join(where)} ORDER BY ts DESC LIMIT ?", (*params, args.limit))
+
+
+def report_devices(args):
+    return ("SELECT name, device_id, flash_count, erase_count, datetime(last_seen / 1000, 'unixepoch') AS last_seen, online, "
+            "app_version FROM devices" + (" WHERE online = 1" if args.online else "") +
+            " ORDER BY last_seen DESC LIMIT ?", (args.limit,))
+
+
+REPORTS = {
+    'flashes': report_flashes,
+    'sessions': report_sessions,
+    'events': report_events,
+    'devices': report_devices,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reports from the collector's SQLite store")
+    parser.add_argument('--db', default='stats.db', help="SQLite file written by mqtt_collector.py --sqlite")
+    subparsers = parser.add_subparsers(dest='report', required=True)
+
+    flashes = subparsers.add_parser('flashes', help="Flashes per device model (or deviceId)")
+    flashes.add_argument('--by', choices=('model', 'device-id'), default='model')
+    sessions = subparsers.add_parser('sessions', help="Sessions per deviceId, or one device's sessions")
+    sessions.add_argument('--device-id')
+    events = subparsers.add_parser('events', help="Latest events")
+    events.add_argument('--type', help="flash, erase, info, ...")
+    events.add_argument('--device-id')
+    devices = subparsers.add_parser('devices', help="Known devices, most recently seen first")
+    devices.add_argument('--online', action='store_true')
+    for subparser in (flashes, sessions, events, devices):
+        subparser.add_argument('--days', type=float, default=7, help="Look back this many days")
+        subparser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    sql, params = REPORTS[args.report](args)
+    db = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    cursor = db.execute(sql, params)
+    columns = [column[0] for column in cursor.description]
+    print('\t'.join(columns))
+    for row in cursor:
+        print('\t'.join('' if value is None else str(value) for value in row))
+    db.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
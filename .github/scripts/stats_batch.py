@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Batched stats payloads for the ESP32 Stats MQTT Collector
+A versioned fixed-layout binary record that carries many flash/erase operations in one publish
+"""
+
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Topic: pierre/stats/{deviceId}/batch
+#
+# Header, little-endian, 8 bytes:
+#   magic      2s  b'PB'
+#   version    u8  1
+#   flags      u8  reserved, 0
+#   count      u16 number of records
+#   name_len   u8  UTF-8 bytes of the device name that follows
+#   ver_len    u8  UTF-8 bytes of the app version that follows (0 = unknown)
+# then the device name, the app version and count records of 6 bytes:
+#   operation  u8  OP_FLASH, OP_ERASE or OP_ONLINE
+#   status     u8  STATUS_SUCCESS or STATUS_FAILURE
+#   repeat     u16 identical operations this record stands for
+#   age        u16 seconds between the operation and the publish
+MAGIC = b'PB'
+VERSION = 1
+HEADER = struct.Struct('<2sBBHBB')
+RECORD = struct.Struct('<BBHH')
+
+OP_FLASH, OP_ERASE, OP_ONLINE = 1, 2, 3
+OPERATIONS = {OP_FLASH: 'flash', OP_ERASE: 'erase', OP_ONLINE: 'online'}
+STATUS_FAILURE, STATUS_SUCCESS = 0, 1
+
+
+class BatchFormatError(ValueError):
+    """Payload is not a batch this collector can read"""
+
+
+def encode_batch(device_name, records, app_version=''):
+    """Build a batch payload; records are (operation, status, repeat, age) tuples"""
+    name = device_name.encode('utf-8')
+    version = app_version.encode('utf-8')
+    if len(name) > 255 or len(version) > 255:
+        raise BatchFormatError("device name and app version are limited to 255 bytes")
+    if len(records) > 0xFFFF:
+        raise BatchFormatError("at most 65535 records per batch")
+    parts = [HEADER.pack(MAGIC, VERSION, 0, len(records), len(name), len(version)), name, version]
+    parts.extend(RECORD.pack(*record) for record in records)
+    return b''.join(parts)
+
+
+def decode_batch(payload):
+    """(device name, app version, record iterator); the records are unpacked lazily in one pass"""
+    if len(payload) < HEADER.size:
+        raise BatchFormatError(f"batch shorter than its {HEADER.size}-byte header")
+    magic, version, _flags, count, name_len, version_len = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise BatchFormatError("not a stats batch")
+    if version != VERSION:
+        raise BatchFormatError(f"unsupported batch version {version}")
+
+    start = HEADER.size + name_len + version_len
+    end = start + count * RECORD.size
+    if len(payload) != end:
+        raise BatchFormatError(f"batch of {count} records should be {end} bytes, got {len(payload)}")
+    view = memoryview(payload)
+    device_name = str(view[HEADER.size:HEADER.size + name_len], 'utf-8')
+    app_version = str(view[HEADER.size + name_len:start], 'utf-8')
+    return device_name, app_version, RECORD.iter_unpack(view[start:end])
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Battery and config telemetry for the ESP32 Stats MQTT Collector
+Per-device samples live in fleet-wide NumPy ring buffers; analysis runs once per snapshot as array math
+"""
+
+import os
+import json
+import logging
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:  # Optional: without NumPy the collector runs without telemetry
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+class TelemetryStore:
+    """Battery and config samples, one row per device, one ring buffer column per sample
+
+    Empty battery slots are NaN and empty config slots are -1, so the analysis needs no per-row counts.
+    A device keeps at most one battery sample per sample_interval (288 x 5 min = a day of history,
+    however chatty it is), and one config sample per interval unless the config changed.
+    """
+
+    def __init__(self, path='stats-telemetry.json', state_path='stats-telemetry.npz',
+                 battery_samples=288, config_samples=32, sample_interval=300,
+                 low_battery=20.0, drain_window=6 * 3600, max_listed=100):
+        self.path = path
+        self.state_path = state_path
+        self.battery_samples = battery_samples
+        self.config_samples = config_samples
+        self.sample_interval = sample_interval
+        self.low_battery = low_battery
+        self.drain_window = drain_window
+        self.max_listed = max_listed  # Longest device list in the summary
+
+        self.enabled = np is not None
+        self.rows = {}           # device name -> row
+        self.names = []
+        self.config_codes = {}   # config payload -> code
+        self.config_values = []
+        self.dirty = False
+        self.capacity = 0
+        if self.enabled:
+            self.allocate(64)
+        else:
+            logger.warning("NumPy is not installed; battery/config telemetry is disabled")
+
+    def allocate(self, capacity):
+        """Grow every array to capacity rows, keeping the existing rows"""
+        def grow(old, fill, dtype, columns):
+            new = np.full((capacity, columns) if columns else capacity, fill, dtype=dtype)
+            if old is not None:
+                new[:len(old)] = old
+            return new
+
+        first = self.capacity == 0
+        self.battery_ts = grow(None if first else self.battery_ts, np.nan, np.float64, self.battery_samples)
+        self.battery_level = grow(None if first else self.battery_level, np.nan, np.float32, self.battery_samples)
+        self.battery_head = grow(None if first else self.battery_head, 0, np.int32, 0)
+        self.config_ts = grow(None if first else self.config_ts, np.nan, np.float64, self.config_samples)
+        self.config_code = grow(None if first else self.config_code, -1, np.int32, self.config_samples)
+        self.config_head = grow(None if first else self.config_head, 0, np.int32, 0)
+        self.capacity = capacity
+
+    def row(self, device_name):
+        row = self.rows.get(device_name)
+        if row is None:
+            row = self.rows[device_name] = len(self.names)
+            self.names.append(device_name)
+            if row >= self.capacity:
+                self.allocate(self.capacity * 2)
+        return row
+
+    def code_for_config(self, value):
+        code = self.config_codes.get(value)
+        if code is None:
+            code = self.config_codes[value] = len(self.config_values)
+            self.config_values.append(value)
+        return code
+
+    def record_battery(self, device_name, ts, level):
+        if not self.enabled:
+            return
+        row = self.row(device_name)
+        head = self.battery_head[row]
+        # The newest sample is one slot behind head; NaN (no samples yet) never throttles
+        if ts - self.battery_ts[row, head - 1] < self.sample_interval:
+            return
+        self.battery_ts[row, head] = ts
+        self.battery_level[row, head] = level
+        self.battery_head[row] = (head + 1) % self.battery_samples
+        self.dirty = True
+
+    def record_config(self, device_name, ts, value):
+        if not self.enabled:
+            return
+        row = self.row(device_name)
+        head = self.config_head[row]
+        code = self.code_for_config(value)
+        if code == self.config_code[row, head - 1] and ts - self.config_ts[row, head - 1] < self.sample_interval:
+            return
+        self.config_ts[row, head] = ts
+        self.config_code[row, head] = code
+        self.config_head[row] = (head + 1) % self.config_samples
+        self.dirty = True
+
+    def analyze(self, now):
+        """Fleet-wide battery levels, drain rates and config distribution in one pass over the arrays"""
+        count = len(self.names)
+        rows = np.arange(count)
+        names = np.array(self.names, dtype=object)
+
+        # Latest battery level per device
+        last = (self.battery_head[:count] - 1) % self.battery_samples
+        latest = self.battery_level[rows, last].astype(np.float64)
+        reporting = ~np.isnan(latest)
+
+        # Least-squares slope of level over time within the window, per device (%/hour)
+        ts = self.battery_ts[:count]
+        level = self.battery_level[:count].astype(np.float64)
+        valid = (ts >= now - self.drain_window) & ~np.isnan(level)
+        samples = valid.sum(axis=1)
+        safe_samples = np.maximum(samples, 1)
+        mean_ts = np.where(valid, ts, 0).sum(axis=1) / safe_samples
+        mean_level = np.where(valid, level, 0).sum(axis=1) / safe_samples
+        dt = np.where(valid, ts - mean_ts[:, None], 0)
+        dl = np.where(valid, level - mean_level[:, None], 0)
+        variance = (dt * dt).sum(axis=1)
+        has_slope = (samples >= 2) & (variance > 0)
+        drain = np.full(count, np.nan)
+        drain[has_slope] = -(dt * dl).sum(axis=1)[has_slope] / variance[has_slope] * 3600
+
+        # Fast drainers: robust z-score (median/MAD) over devices with a slope
+        fast = np.zeros(count, dtype=bool)
+        drain_median = None
+        if has_slope.any():
+            drains = drain[has_slope]
+            drain_median = float(np.median(drains))
+            mad = float(np.median(np.abs(drains - drain_median))) * 1.4826
+            fast[has_slope] = drains > drain_median + max(3 * mad, 1.0)
+
+        low = reporting & (latest < self.low_battery)
+
+        # Latest config per device
+        config_last = (self.config_head[:count] - 1) % self.config_samples
+        codes = self.config_code[rows, config_last]
+        distribution = np.bincount(codes[codes >= 0], minlength=len(self.config_values))
+
+        levels = latest[reporting]
+        order_low = np.argsort(latest[low])[:self.max_listed]
+        order_fast = np.argsort(-drain[fast])[:self.max_listed]
+        return {
+            'generatedAt': datetime.fromtimestamp(now, timezone.utc).isoformat(),
+            'devices': count,
+            'battery': {
+                'reporting': int(reporting.sum()),
+                'median': float(np.median(levels)) if levels.size else None,
+                'p10': float(np.percentile(levels, 10)) if levels.size else None,
+                'p90': float(np.percentile(levels, 90)) if levels.size else None,
+                'lowCount': int(low.sum()),
+                'low': [{'device': name, 'level': float(value)}
+                        for name, value in zip(names[low][order_low], latest[low][order_low])],
+            },
+            'drain': {
+                'windowHours': self.drain_window / 3600,
+                'devicesWithSlope': int(has_slope.sum()),
+                'medianPerHour': drain_median,
+                'fastCount': int(fast.sum()),
+                'fast': [{'device': name, 'perHour': round(float(value), 2)}
+                         for name, value in zip(names[fast][order_fast], drain[fast][order_fast])],
+            },
+            'config': {value: int(n) for value, n in zip(self.config_values, distribution) if n},
+        }
+
+    def merge(self, stores):
+        """Replace the contents with the rows of several stores (shards own disjoint devices)"""
+        self.rows, self.names, self.config_codes, self.config_values = {}, [], {}, []
+        self.capacity = 0
+        self.allocate(64)
+        for store in stores:
+            if not store.enabled or not store.names:
+                continue
+            count = len(store.names)
+            targets = np.array([self.row(name) for name in store.names])
+            # -1 (empty) indexes the trailing -1 of the remap table
+            remap = np.array([self.code_for_config(value) for value in store.config_values] + [-1], dtype=np.int32)
+            self.battery_ts[targets] = store.battery_ts[:count]
+            self.battery_level[targets] = store.battery_level[:count]
+            self.battery_head[targets] = store.battery_head[:count]
+            self.config_ts[targets] = store.config_ts[:count]
+            self.config_code[targets] = remap[store.config_code[:count]]
+            self.config_head[targets] = store.config_head[:count]
+        self.dirty = True
+
+    def load(self):
+        if not self.enabled or not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with np.load(self.state_path, allow_pickle=False) as state:
+                if state['battery_ts'].shape[1] != self.battery_samples or state['config_ts'].shape[1] != self.config_samples:
+                    logger.warning(f"Ignoring {self.state_path}: ring buffer sizes changed")
+                    return
+                self.names = [str(name) for name in state['names']]
+                self.rows = {name: row for row, name in enumerate(self.names)}
+                self.config_values = [str(value) for value in state['config_values']]
+                self.config_codes = {value: code for code, value in enumerate(self.config_values)}
+                self.capacity = 0
+                self.allocate(max(64, len(self.names) * 2))
+                count = len(self.names)
+                for name in ('battery_ts', 'battery_level', 'battery_head', 'config_ts', 'config_code', 'config_head'):
+                    getattr(self, name)[:count] = state[name]
+            logger.info(f"Loaded telemetry for {len(self.names)} devices")
+        except Exception as e:
+            logger.error(f"Error loading telemetry: {e}")
+
+    def save(self, now):
+        """Write the fleet summary (and the sample state) if new samples arrived"""
+        if not self.enabled or not self.dirty:
+            return
+        if self.path:
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.analyze(now), f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        if self.state_path:
+            count = len(self.names)
+            tmp_path = f'{self.state_path}.tmp.npz'
+            np.savez_compressed(
+                tmp_path, names=np.array(self.names, dtype=str), config_values=np.array(self.config_values, dtype=str),
+                battery_ts=self.battery_ts[:count], battery_level=self.battery_level[:count],
+                battery_head=self.battery_head[:count], config_ts=self.config_ts[:count],
+                config_code=self.config_code[:count], config_head=self.config_head[:count])
+            os.replace(tmp_path, self.state_path)
+        self.dirty = False